@@ -11,9 +11,15 @@ CREATE TABLE IF NOT EXISTS t_datasets (
 -- -----------------------
 -- table prefixes
 -- -----------------------
+-- prefix is unique, so concurrent writers can add prefixes with
+-- INSERT ... ON CONFLICT (prefix) DO NOTHING and look up the winner's id
+-- (needs Postgres 9.5+). Databases created without the constraint are
+-- migrated with migrate2unique.sh, which merges duplicate prefixes and
+-- then adds it; the origin tools fail to add prefixes until then.
 CREATE TABLE IF NOT EXISTS t_prefixes (
   id          SERIAL PRIMARY KEY,
-  prefix      INET NOT NULL
+  prefix      INET NOT NULL,
+  UNIQUE (prefix)
 );
 
 -- -----------------------
@@ -31,6 +37,8 @@ CREATE TABLE IF NOT EXISTS t_origins (
 -- to optimize performance and vacuum process use partition
 -- create partition table per year_month, as follows:
 -- CREATE TABLE IF NOT EXISTS t_origins_yyyy_mm () INHERITS (t_origins);
+-- bgp-origins --staging adds months loaded again as child tables of the
+-- month, t_origins_yyyy_mm_N INHERITS (t_origins_yyyy_mm)
 
 -- -----------------------
 -- table origin ttl
@@ -91,3 +99,38 @@ CREATE TABLE IF NOT EXISTS t_origin_stats (
   FOREIGN KEY (dataset_id) REFERENCES t_datasets (id),
   PRIMARY KEY (dataset_id)
 );
+
+-- -----------------------
+-- table origin intervals
+-- -----------------------
+-- alternative to t_origins (bgp-origins.py --intervals): one row per
+-- prefix origin association and collector, from the first (ts0) to the
+-- last (ts1) consecutive dataset it was seen in; ts1 is NULL while the
+-- association is still seen in the last ingested dataset (ts_last)
+CREATE TABLE IF NOT EXISTS t_origin_intervals (
+  maptype     TEXT NOT NULL,
+  subtype     TEXT NOT NULL,
+  prefix_id   INT,
+  asn         INT,
+  ts0         timestamp without time zone NOT NULL,
+  ts1         timestamp without time zone,
+  PRIMARY KEY (maptype, subtype, prefix_id, asn, ts0),
+  FOREIGN KEY (prefix_id) REFERENCES t_prefixes (id)
+);
+
+CREATE TABLE IF NOT EXISTS t_origin_intervals_ts (
+  maptype     TEXT NOT NULL,
+  subtype     TEXT NOT NULL,
+  ts_last     timestamp without time zone NOT NULL,
+  PRIMARY KEY (maptype, subtype)
+);
+
+-- rebuild the origins of a dataset from the intervals, same rows as
+-- SELECT prefix_id, asn FROM t_origins WHERE dataset_id = did
+CREATE OR REPLACE FUNCTION f_origins_snapshot(did INT)
+RETURNS TABLE (prefix_id INT, asn INT) AS $$
+  SELECT i.prefix_id, i.asn FROM t_origin_intervals AS i
+  JOIN t_datasets AS d
+    ON i.maptype = d.maptype AND i.subtype = d.subtype
+  WHERE d.id = did AND i.ts0 <= d.ts AND (i.ts1 IS NULL OR i.ts1 >= d.ts)
+$$ LANGUAGE SQL STABLE;
@@ -0,0 +1,50 @@
+# make t_prefixes.prefix unique in databases created before the constraint,
+# needed by the INSERT ... ON CONFLICT (prefix) of the origin tools.
+# Duplicate prefixes are merged into their lowest id, rows referencing the
+# other ids are re-pointed (or dropped if the kept id has them already).
+# Stop all writers and finalize staging tables (bgp-origins --staging)
+# before, everything runs in one transaction.
+DB=${1:-bgp.origins.rv_eqix}
+echo " make prefixes unique in ${DB}"
+psql -v ON_ERROR_STOP=1 --single-transaction ${DB} <<'EOF'
+LOCK TABLE t_prefixes IN EXCLUSIVE MODE;
+
+CREATE TEMP TABLE tmp_prefix_dups ON COMMIT DROP AS
+  SELECT p.id AS old_id, k.id AS new_id FROM t_prefixes AS p
+  JOIN (SELECT prefix, min(id) AS id FROM t_prefixes
+        GROUP BY prefix HAVING count(*) > 1) AS k
+  ON p.prefix = k.prefix AND p.id <> k.id;
+SELECT count(*) AS duplicate_prefix_ids FROM tmp_prefix_dups;
+
+-- tables referencing t_prefixes, with the rest of their primary key;
+-- partitions of t_origins are covered through their parent
+DO $$
+DECLARE
+  r RECORD;
+  same TEXT;
+BEGIN
+  FOR r IN SELECT * FROM (VALUES
+      ('t_origins', ARRAY['dataset_id', 'asn']),
+      ('t_origin_ttl_data', ARRAY['origin_ttl_id', 'asn', 'ts0', 'ts1', 'ttl']),
+      ('t_origin_intervals', ARRAY['maptype', 'subtype', 'asn', 'ts0'])
+    ) AS v (tbl, cols) LOOP
+    IF to_regclass(r.tbl) IS NULL THEN
+      CONTINUE;
+    END IF;
+    SELECT string_agg(format('x.%1$I = o.%1$I', c), ' AND ') INTO same
+      FROM unnest(r.cols) AS c;
+    EXECUTE format('DELETE FROM %1$I AS o USING tmp_prefix_dups AS d '
+                   'WHERE o.prefix_id = d.old_id AND EXISTS (SELECT 1 '
+                   'FROM %1$I AS x WHERE x.prefix_id = d.new_id AND %2$s)',
+                   r.tbl, same);
+    EXECUTE format('UPDATE %I AS o SET prefix_id = d.new_id '
+                   'FROM tmp_prefix_dups AS d WHERE o.prefix_id = d.old_id',
+                   r.tbl);
+    RAISE NOTICE 're-pointed prefix ids of %', r.tbl;
+  END LOOP;
+END
+$$;
+
+DELETE FROM t_prefixes AS p USING tmp_prefix_dups AS d WHERE p.id = d.old_id;
+ALTER TABLE t_prefixes ADD CONSTRAINT t_prefixes_prefix_key UNIQUE (prefix);
+EOF
@@ -15,40 +15,29 @@ from __future__ import print_function
 import argparse
 import gzip
 import os
-import psycopg2
-import radix
 import re
 import sys
 import multiprocessing as mp
 
-from collections import OrderedDict
 from datetime import datetime, timedelta
-from netaddr import IPSet, IPNetwork
+# own imports
+import reserved
+import sqlitedb
+from pgorigins import iter_origins_range
 
 verbose = False
 warning = False
 logging = False
 
+# results are inserted in batches of this size per worker
+batch_size = 100
+
 re_file_rv = re.compile('rib.(\d+).(\d\d\d\d).bz2')
 re_file_rr = re.compile('bview.(\d+).(\d\d\d\d).gz')
 
 re_path_rv = re.compile('.*/([a-z0-9\.-]+)/bgpdata/\d\d\d\d.\d\d/RIBS.*')
 re_path_rr = re.compile('.*/(rrc\d\d)/\d\d\d\d.\d\d.*')
 
-reserved_ipv4 = IPSet (['0.0.0.0/8',                                        # host on this network (RFC1122)
-                        '10.0.0.0/8','172.16.0.0/12','192.168.0.0/16',      # private address space (RFC1918)
-                        '100.64.0.0/10',                                    # shared address space (RFC6598)
-                        '127.0.0.0/8',                                      # loopback (RFC1122)
-                        '169.254.0.0/16',                                   # linklocal (RFC3927)
-                        '192.0.0.0/24',                                     # special purpose (RFC6890)
-                        '192.0.0.0/29',                                     # DS-lite (RFC6333)
-                        '192.0.2.0/24','198.51.100.0/24','203.0.113.0/24',  # test net 1-3 (RFC5737)
-                        '224.0.0.0/4',                                      # multicast address space
-                        '240.0.0.0/4',                                      # future use (RFC1122)
-                        '255.255.255.255/32'                                # limited broadcast
-                    ])
-all_ips_valid = len(IPSet(['0.0.0.0/0']) - reserved_ipv4)
-
 ## helper function ##
 
 def prefixlen (prefix):
@@ -82,49 +71,24 @@ def valid_date(s):
         raise argparse.ArgumentTypeError(msg)
 
 ## public and thread funtions ##
-def get_origins(dbconnstr, did, ts_str):
-    print_log ("CALL get_origins (%s, %s, %s)" % (dbconnstr, did, ts_str))
-    query_origins = ("SELECT p.prefix, o.asn FROM "
-                     "(SELECT * FROM %s WHERE dataset_id = '%s') AS o "
-                     "LEFT JOIN t_prefixes AS p ON o.prefix_id = p.id")
-    ym_str = ts_str.strftime("%Y_%m")
-    table = "t_origins_"+ym_str
-    ptree = dict()
+def connect(dbconnstr):
     try:
+        import psycopg2
         con = psycopg2.connect(dbconnstr)
     except Exception, e:
-        print_error("get_origins: connecting to database")
+        print_error("%s: connecting to database" % (mp.current_process().name))
         print_error("failed with: %s" % ( e.message))
         sys.exit(1)
-    cur = con.cursor()
-    # get origins of dataset
-    try:
-        print_info("get_origins: execute query")
-        query = query_origins % (table, did)
-        cur.execute(query)
-        rs = cur.fetchall()
-    except Exception, e:
-        print_error("QUERY: %s ; failed with: %s" % (query, e.message))
-        con.rollback()
-    else:
-        print_info("get_origins: process response")
-        # update timestamps of prefix origin association
-        for row in rs:
-            prefix = str(row[0])
-            origin = int(row[1])
-            if prefix not in ptree:
-                ptree[prefix] = list()
-            if origin not in ptree[prefix]:
-                ptree[prefix].append(origin)
-    return ptree
+    return con
 
 def get_stat(pt):
     print_log("CALL get_stat")
+    from netaddr import IPSet
     ips = IPSet(pt.keys())
     num_ips_all = len(ips)
-    num_ips_valid = len(ips - reserved_ipv4)
+    num_ips_valid = len(ips - reserved.ipv4())
     num_ips_bogus = num_ips_all - num_ips_valid
-    ipspace = num_ips_valid / all_ips_valid
+    ipspace = float(num_ips_valid) / reserved.ipv4_valid()
     pfxlen = dict()
     asn = set()
     num_pfx_moas = 0
@@ -146,15 +110,14 @@ def get_stat(pt):
         pl_dict[i+1] = 0
     for pl in pfxlen:
         pl_dict[pl] = len(pfxlen[pl])
-    str_pfx_len = str(pl_dict[0])
-    for i in range(1,32):
-        str_pfx_len = str_pfx_len + "," + str(pl_dict[i])
+    str_pfx_len = ','.join(str(pl_dict[i+1]) for i in range(32))
     ret = [num_asn,num_ips_valid, num_ips_bogus, ipspace,
            num_pfx, num_pfx_moas, str_pfx_len]
     return ret
 
 def get_diff(pt0, pt1):
     print_log("CALL get_diff")
+    from netaddr import IPSet
     pt0IPs = IPSet(pt0.keys())
     pt1IPs = IPSet(pt1.keys())
     num_ips_new = len(pt1IPs - pt0IPs)
@@ -176,55 +139,120 @@ def get_diff(pt0, pt1):
             asn1.add(a)
     num_asn_new = len(asn1 - asn0)
     num_asn_del = len(asn0 - asn1)
-    ret = [num_asn_new, nums_asn_del, num_ips_new, num_ips_del,
+    ret = [num_asn_new, num_asn_del, num_ips_new, num_ips_del,
            num_pfx_new, num_pfx_del, num_pfx_mod]
     return ret
 
-def worker(dbconnstr, queue):
+def worker(dbconnstr, queue, sqlite=False):
     print_log ("START worker")
-
-    for data in iter(queue.get, 'DONE'):
+    # one connection per worker for all queries and inserts
+    if sqlite:
+        con = sqlitedb.connect(dbconnstr)
+        write = output_sqlite
+    else:
+        con = connect(dbconnstr)
+        write = output
+    batch = list()
+    # each chunk is a run of consecutive datasets, loaded in one go; with
+    # carry set its first dataset was already done by the previous chunk
+    for chunk, carry in iter(queue.get, 'DONE'):
         try:
-            did0 = data[0]
-            ts0  = data[1]
-            did1 = data[2]
-            ts1  = data[3]
-            ptree0 = get_origins(dbconnstr, did0, ts0)
-            ptree1 = get_origins(dbconnstr, did1, ts1)
-            print_info ("%s origins done ..." % (mp.current_process().name))
-            stat0 = get_stat(ptree0)
-            print_info ("%s stat0 done ..." % (mp.current_process().name))
-            stat1 = get_stat(ptree1)
-            print_info ("%s stat1 done ..." % (mp.current_process().name))
-            diffs = get_diff(ptree0, ptree1)
-            print_info ("%s diffs done ..." % (mp.current_process().name))
-            odata = (did0, did1, stat0, stat1, diffs)
-            output(dbconnstr, odata)
-            print_info ("%s output done ..." % (mp.current_process().name))
+            prev = None
+            if sqlite:
+                loaded = sqlitedb.iter_origins(con, chunk)
+            else:
+                loaded = iter_origins_range(dbconnstr, chunk)
+            for did1, ts1, ptree1 in loaded:
+                print_info ("%s origins done ..." % (mp.current_process().name))
+                stat1 = None
+                if (prev is not None) or (not carry):
+                    stat1 = get_stat(ptree1)
+                    print_info ("%s stat done ..." % (mp.current_process().name))
+                if prev is not None:
+                    did0, ptree0, stat0 = prev
+                    diffs = get_diff(ptree0, ptree1)
+                    print_info ("%s diffs done ..." % (mp.current_process().name))
+                    odata = (did0, did1, stat0, stat1, diffs)
+                    batch.append(odata)
+                prev = (did1, ptree1, stat1)
+                if len(batch) >= batch_size:
+                    write(con, batch)
+                    batch = list()
+                    print_info ("%s output done ..." % (mp.current_process().name))
         except Exception, e:
             print_error("%s failed with: %s" %
-                        (mp.current_process().name, e.message))
+                        (mp.current_process().name, str(e)))
+    write(con, batch)
+    con.close()
     return True
 
-def output(dbconnstr, odata):
+def output_sqlite(con, batch):
+    stats = list()
+    diffs = list()
+    for odata in batch:
+        for did, stat in ((odata[0], odata[2]), (odata[1], odata[3])):
+            if stat is not None:
+                stats.append([did] + list(stat))
+        diffs.append([odata[0], odata[1]] + list(odata[4]))
     try:
-        con = psycopg2.connect(dbconnstr)
+        sqlitedb.insert_stats(con, stats)
+        sqlitedb.insert_diffs(con, diffs)
     except Exception, e:
-        print_error("output: connecting to database")
-        print_error("failed with: %s" % ( e.message))
-        sys.exit(1)
+        print_error("INSERT: %d diffs ; failed with: %s" %
+                    (len(diffs), str(e)))
+        con.rollback()
+    return True
+
+def output(con, batch):
+    from psycopg2.extras import execute_values
+    if len(batch) == 0:
+        return True
     cur = con.cursor()
-    insert_stats = "INSERT INTO t_origin_stats VALUES (%s,%s,%s,%s,%s,%s,%s,%s)"
-    insert_diffs = "INSERT INTO t_origin_diffs VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s)"
-    stat0 = list(odata[0])
-    stat0.extend(odata[2])
-    stat1 = list(odata[1])
-    stat1.extend(odata[3])
-    diffs = list(odata[0],odata[1])
-    diffs.extend(odata[4])
-    print_info ("STAT0: " + ';'.join( str(x) for x in stat0))
-    print_info ("STAT1: " + ';'.join( str(x) for x in stat1))
-    print_info ("DIFFS: " + ';'.join( str(x) for x in diffs))
+    # stats of a dataset may exist already, as part of the previous pair
+    insert_stats = ("INSERT INTO t_origin_stats VALUES %s "
+                    "ON CONFLICT (dataset_id) DO NOTHING")
+    insert_stat = ("INSERT INTO t_origin_stats VALUES (%s,%s,%s,%s,%s,%s,%s,%s) "
+                   "ON CONFLICT (dataset_id) DO NOTHING")
+    # pairs of a rerun over the same datasets are kept as they are
+    insert_diffs = ("INSERT INTO t_origin_diffs VALUES %s "
+                    "ON CONFLICT (dataset_id0, dataset_id1) DO NOTHING")
+    insert_diff = ("INSERT INTO t_origin_diffs VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s) "
+                   "ON CONFLICT (dataset_id0, dataset_id1) DO NOTHING")
+    stats = list()
+    diffs = list()
+    for odata in batch:
+        for did, stat in ((odata[0], odata[2]), (odata[1], odata[3])):
+            if stat is None:
+                continue
+            row = [did]
+            row.extend(stat)
+            print_info ("STAT: " + ';'.join( str(x) for x in row))
+            stats.append(row)
+        diff = [odata[0],odata[1]]
+        diff.extend(odata[4])
+        print_info ("DIFFS: " + ';'.join( str(x) for x in diff))
+        diffs.append(diff)
+    try:
+        print_info("output: insert %d diffs" % len(diffs))
+        if stats:
+            execute_values(cur, insert_stats, stats)
+        execute_values(cur, insert_diffs, diffs)
+        con.commit()
+    except Exception, e:
+        print_error("INSERT: batch of %d diffs ; failed with: %s" %
+                    (len(diffs), e.message))
+        con.rollback()
+        # retry row by row, so one bad row does not drop the whole batch
+        for query, rows in ((insert_stat, stats), (insert_diff, diffs)):
+            for row in rows:
+                try:
+                    cur.execute(query, row)
+                    con.commit()
+                except Exception, e:
+                    print_error("INSERT: %s ; failed with: %s" %
+                                (';'.join(str(x) for x in row), e.message))
+                    con.rollback()
+    return True
 
 def main():
     parser = argparse.ArgumentParser()
@@ -237,9 +265,11 @@ def main():
     parser.add_argument('-v', '--verbose',
                         help='print everything.',
                         action='store_true')
-    parser.add_argument('-p', '--postgres',
-                        help='Use PostgresqlDB for input and output.',
-                        required=True)
+    dbmode = parser.add_mutually_exclusive_group(required=True)
+    dbmode.add_argument('-p', '--postgres',
+                        help='Use PostgresqlDB for input and output.')
+    dbmode.add_argument('--sqlite',
+                        help='Use SQLite database file for input and output.')
     parser.add_argument('-b', '--begin',
                         help='Begin date (inclusive), format: yyyy-mm-dd',
                         type=valid_date, required=True)
@@ -280,40 +310,63 @@ def main():
     # prepare some vars
     input_queue = mp.Queue()
     # get all matching datasets
-    try:
-        con = psycopg2.connect(dbconnstr)
-    except Exception, e:
-        print_error("origin_ttl_postgres: connecting to database")
-        print_error("failed with: %s" % ( e.message))
-        sys.exit(1)
-    cur = con.cursor()
+    if args['sqlite']:
+        con = sqlitedb.connect(args['sqlite'])
+        pairs = sqlitedb.get_pairs(con, begin, until, maptype, subtype)
+        con.close()
+        dbconnstr = args['sqlite']
+    else:
+        try:
+            import psycopg2
+            con = psycopg2.connect(dbconnstr)
+        except Exception, e:
+            print_error("origin_ttl_postgres: connecting to database")
+            print_error("failed with: %s" % ( e.message))
+            sys.exit(1)
+        cur = con.cursor()
 
-    query_datasets = ("SELECT id, ts FROM t_datasets WHERE ts >= '%s' "
-                      "AND ts < '%s' AND maptype = '%s' "
-                      "AND subtype = '%s' ORDER BY ts")
-    datasets = OrderedDict()
-    query = query_datasets % (begin,until,maptype,subtype)
-    try:
-        cur.execute(query)
-        rs = cur.fetchall()
-        datasets = OrderedDict((row[0], row[1]) for row in rs)
-    except Exception, e:
-        print_error("QUERY: %s ; failed with: %s" % (query, e.message))
-        con.rollback()
-    print_log ("FOUND %s datasets." % str(len(datasets)))
-    # fill input_queue
+        # consecutive pairs of datasets that have no diffs yet, anti-join
+        # against the results
+        query_pairs = ("SELECT d.id0, d.ts0, d.id1, d.ts1 FROM "
+                       "(SELECT LAG(id) OVER w AS id0, LAG(ts) OVER w AS ts0, "
+                       "id AS id1, ts AS ts1 FROM t_datasets "
+                       "WHERE ts >= %s AND ts < %s AND maptype = %s "
+                       "AND subtype = %s WINDOW w AS (ORDER BY ts)) AS d "
+                       "WHERE d.id0 IS NOT NULL AND NOT EXISTS "
+                       "(SELECT 1 FROM t_origin_diffs AS o "
+                       "WHERE o.dataset_id0 = d.id0 AND o.dataset_id1 = d.id1) "
+                       "ORDER BY d.ts1")
+        pairs = list()
+        query = cur.mogrify(query_pairs, [begin,until,maptype,subtype])
+        try:
+            cur.execute(query)
+            pairs = cur.fetchall()
+        except Exception, e:
+            print_error("QUERY: %s ; failed with: %s" % (query, e.message))
+            con.rollback()
+    print_log ("FOUND %s missing pairs." % str(len(pairs)))
+    # fill input_queue, one chunk per month and run of consecutive pairs;
+    # a chunk continuing the previous one carries its last dataset
     print_info ("fill input queue")
-    for i in range(0, len(datasets)-1):
-        d0 = datasets.items()[i]
-        d1 = datasets.items()[i+1]
-        data = (d0[0],d0[1],d1[0],d1[1])
-        input_queue.put(data)
-    # start workers
+    chunk = None
+    for did0, ts0, did1, ts1 in pairs:
+        if chunk and (chunk[0][-1][0] == did0) and \
+                (chunk[0][-1][1].strftime("%Y_%m") == ts1.strftime("%Y_%m")):
+            chunk[0].append((did1, ts1))
+            continue
+        if chunk:
+            input_queue.put(chunk)
+        carry = bool(chunk) and (chunk[0][-1][0] == did0)
+        chunk = ([(did0, ts0), (did1, ts1)], carry)
+    if chunk:
+        input_queue.put(chunk)
+    # start workers, they inherit the reserved tables
     print_info("start workers")
+    reserved.warm()
     processes = []
     for w in xrange(workers):
         p = mp.Process(target=worker,
-                       args=(dbconnstr,input_queue))
+                       args=(dbconnstr,input_queue,bool(args['sqlite'])))
         p.start()
         processes.append(p)
         input_queue.put('DONE')
@@ -15,43 +15,33 @@ from __future__ import print_function
 import argparse
 import gzip
 import os
-import psycopg2
-import radix
 import re
 import sys
 import multiprocessing as mp
 import math
 
+from array import array
 from collections import OrderedDict
 from datetime import datetime, timedelta
-from netaddr import IPSet, IPNetwork
+# own imports
+import sqlitedb
+from pgorigins import CopyReader
 
 verbose = False
 warning = False
 logging = False
 
+# results are inserted in batches of this size per worker
+batch_size = 100
+# compute aggregates in the database, per monthly partition
+server_side = False
+
 re_file_rv = re.compile('rib.(\d+).(\d\d\d\d).bz2')
 re_file_rr = re.compile('bview.(\d+).(\d\d\d\d).gz')
 
 re_path_rv = re.compile('.*/([a-z0-9\.-]+)/bgpdata/\d\d\d\d.\d\d/RIBS.*')
 re_path_rr = re.compile('.*/(rrc\d\d)/\d\d\d\d.\d\d.*')
 
-nonunicast_ipv6 = IPSet (['::1/128','::/128',         # Node-Scoped Unicast
-                        '::FFFF:0:0/96',            # IPv4-Mapped Addresses
-                        'fe80::/10',                # Link-Scoped Unicast
-                        'fc00::/7',                 # Unique-Local
-                        '2001:0000::/23',           # IANA testing
-                        '2001:db8::/32',            # Documentation Prefix
-                        '5f00::/8','3ffe::/16',     # formerly 6bone testing
-                        'ff00::/8',                 # multicast
-                    ])
-special_ipv6 = IPSet  (['2002::/16',                # 6to4
-                        '2001::/32',                # Toredo
-                        '2001:10::/28',             # ORCHID
-                    ])
-
-reserved_ipv6 = nonunicast_ipv6 - special_ipv6
-
 ## helper function ##
 
 def prefixlen (prefix):
@@ -85,116 +75,245 @@ def valid_date(s):
         raise argparse.ArgumentTypeError(msg)
 
 ## public and thread funtions ##
-def get_origins(dbconnstr, did, ts_str):
-    print_log ("CALL get_origins (%s, %s, %s)" % (dbconnstr, did, ts_str))
-    query_origins = ("SELECT p.prefix, o.asn FROM "
-                     "(SELECT * FROM %s WHERE dataset_id = '%s') AS o "
-                     "LEFT JOIN t_prefixes AS p ON o.prefix_id = p.id")
-    ym_str = ts_str.strftime("%Y_%m")
-    table = "t_origins_"+ym_str
-    ptree = dict()
+def connect(dbconnstr):
     try:
+        import psycopg2
         con = psycopg2.connect(dbconnstr)
     except Exception, e:
-        print_error("get_origins: connecting to database")
+        print_error("%s: connecting to database" % (mp.current_process().name))
         print_error("failed with: %s" % ( e.message))
         sys.exit(1)
+    return con
+
+class OriginsBuilder(object):
+    # compact layout (prefixes, offsets, asns) of (prefix, asn) rows with
+    # the rows of one prefix adjacent: origin ASNs of prefixes[i] are
+    # asns[offsets[i]:offsets[i+1]], as buildOrigins of bgp-origins
+    def __init__(self):
+        self.prefixes = list()
+        self.offsets = array('I', [0])
+        self.asns = array('I')
+        self.seen = set()
+
+    def add(self, prefix, asn):
+        if (not self.prefixes) or (self.prefixes[-1] != prefix):
+            self.prefixes.append(prefix)
+            self.offsets.append(len(self.asns))
+            self.seen = set()
+        if asn not in self.seen:
+            self.seen.add(asn)
+            self.asns.append(asn)
+            self.offsets[-1] = len(self.asns)
+
+    def origins(self):
+        return self.prefixes, self.offsets, self.asns
+
+def get_origins(con, did, ts_str):
+    print_log ("CALL get_origins (%s, %s)" % (did, ts_str))
+    query_origins = ("COPY (SELECT p.prefix, o.asn FROM "
+                     "(SELECT * FROM %s WHERE dataset_id = %d) AS o "
+                     "LEFT JOIN t_prefixes AS p ON o.prefix_id = p.id "
+                     "ORDER BY o.prefix_id) TO STDOUT")
+    ym_str = ts_str.strftime("%Y_%m")
+    table = "t_origins_"+ym_str
+    builder = OriginsBuilder()
+    def add(cols):
+        if cols[0] == '\\N':
+            return
+        builder.add(cols[0], int(cols[1]))
     cur = con.cursor()
-    # get origins of dataset
+    # stream origins of dataset, rows are decoded as they arrive
+    query = query_origins % (table, int(did))
     try:
         print_info("get_origins: execute query")
-        query = query_origins % (table, did)
-        cur.execute(query)
-        rs = cur.fetchall()
+        reader = CopyReader(add)
+        cur.copy_expert(query, reader)
+        reader.flush()
     except Exception, e:
         print_error("QUERY: %s ; failed with: %s" % (query, e.message))
         con.rollback()
-    else:
-        print_info("get_origins: process response")
-        # update timestamps of prefix origin association
-        for row in rs:
-            prefix = str(row[0])
-            origin = int(row[1])
-            if prefix not in ptree:
-                ptree[prefix] = list()
-            if origin not in ptree[prefix]:
-                ptree[prefix].append(origin)
-    return ptree
+    return builder.origins()
+
+def get_origins_sqlite(con, did, ts):
+    builder = OriginsBuilder()
+    for prefix, asn in sqlitedb.get_origin_rows(con, did, ts):
+        builder.add(prefix, asn)
+    return builder.origins()
 
 def get_stat(pt):
     print_log("CALL get_stat")
-    ips = IPSet(pt.keys())
     num_ips_all = 0
     ips_valid = 0
     num_ips_valid = 0
     num_ips_bogus = 0
     ipspace = 0
     pfxlen = dict()
-    asn = set()
     num_pfx_moas = 0
-    # eval prefix tree
-    for p in pt:
-        pl = prefixlen(p)
-        for a in pt[p]:
-            asn.add(a)
-        if len(pt[p]) > 1:
+    # eval origins, compact layout of get_origins
+    prefixes, offsets, asns = pt
+    for i in xrange(len(prefixes)):
+        pl = prefixlen(prefixes[i])
+        if offsets[i+1] - offsets[i] > 1:
             num_pfx_moas += 1
-        if pl not in pfxlen:
-            pfxlen[pl] = list()
-        pfxlen[pl].append(p)
-    num_asn = len(asn)
-    num_pfx = len(pt.keys())
+        pfxlen[pl] = pfxlen.get(pl, 0) + 1
+    num_asn = len(set(asns))
+    num_pfx = len(prefixes)
     # prefix and ip results
     pl_dict = dict()
     for i in range(128): # init 1-128 with 0
         pl_dict[i+1] = 0
     for pl in pfxlen:
-        pl_dict[pl] = len(pfxlen[pl])
+        pl_dict[pl] = pfxlen[pl]
     str_pfx_len = ','.join(str(pl_dict[i+1]) for i in range(128))
     ret = [num_asn,num_ips_valid, num_ips_bogus, ipspace,
            num_pfx, num_pfx_moas, str_pfx_len]
     return ret
 
+def get_stats_server(con, table, datasets):
+    # aggregates of all datasets of one monthly partition, computed by the
+    # database; returns one stats row per dataset as get_stat does
+    print_log ("CALL get_stats_server (%s, %d datasets)" %
+               (table, len(datasets)))
+    query_asns = ("SELECT dataset_id, COUNT(DISTINCT asn) FROM %s "
+                  "WHERE dataset_id IN (%s) GROUP BY dataset_id")
+    query_pfxlen = ("SELECT o.dataset_id, masklen(p.prefix), COUNT(*), "
+                    "SUM(CASE WHEN o.cnt > 1 THEN 1 ELSE 0 END) FROM "
+                    "(SELECT dataset_id, prefix_id, COUNT(asn) AS cnt "
+                    "FROM %s WHERE dataset_id IN (%s) "
+                    "GROUP BY dataset_id, prefix_id) AS o "
+                    "JOIN t_prefixes AS p ON o.prefix_id = p.id "
+                    "GROUP BY o.dataset_id, masklen(p.prefix)")
+    dids = ','.join(str(int(did)) for did, ts in datasets)
+    # num_asn, num_ips_valid, num_ips_bogus, ipspace, num_pfx, num_pfx_moas
+    stats = OrderedDict((int(did), [0, 0, 0, 0, 0, 0]) for did, ts in datasets)
+    pl_dicts = dict((did, dict()) for did in stats)
+    cur = con.cursor()
+    try:
+        query = query_asns % (table, dids)
+        cur.execute(query)
+        for row in cur.fetchall():
+            stats[row[0]][0] = row[1]
+        query = query_pfxlen % (table, dids)
+        cur.execute(query)
+        for row in cur.fetchall():
+            stats[row[0]][4] += row[2]
+            stats[row[0]][5] += row[3]
+            pl_dicts[row[0]][row[1]] = row[2]
+    except Exception, e:
+        print_error("QUERY: %s ; failed with: %s" % (query, e.message))
+        con.rollback()
+        return list()
+    ret = list()
+    for did in stats:
+        pl_dict = pl_dicts[did]
+        str_pfx_len = ','.join(str(pl_dict.get(i+1, 0)) for i in range(128))
+        odata = [did]
+        odata.extend(stats[did])
+        odata.append(str_pfx_len)
+        ret.append(odata)
+    return ret
+
 def worker(dbconnstr, queue):
     print_log ("START worker")
+    # one connection per worker for all queries and inserts
+    con = connect(dbconnstr)
+    batch = list()
+    for data in iter(queue.get, 'DONE'):
+        try:
+            did = data[0]
+            ts  = data[1]
+            origins = get_origins(con, did, ts)
+            print_info ("%s get_origins done ..." % (mp.current_process().name))
+            stat = get_stat(origins)
+            print_info ("%s get_stat done ..." % (mp.current_process().name))
+            odata = list()
+            odata.append(did)
+            odata.extend(stat)
+            batch.append(odata)
+            if len(batch) >= batch_size:
+                output(con, batch)
+                batch = list()
+                print_info ("%s output done ..." % (mp.current_process().name))
+        except Exception, e:
+            print_error("%s failed with: %s" %
+                        (mp.current_process().name, e.message))
+    output(con, batch)
+    con.close()
+    return True
 
+def worker_sqlite(fname, queue):
+    print_log ("START worker_sqlite")
+    con = sqlitedb.connect(fname)
+    batch = list()
     for data in iter(queue.get, 'DONE'):
         try:
             did = data[0]
             ts  = data[1]
-            origins = get_origins(dbconnstr, did, ts)
+            origins = get_origins_sqlite(con, did, ts)
             print_info ("%s get_origins done ..." % (mp.current_process().name))
             stat = get_stat(origins)
             print_info ("%s get_stat done ..." % (mp.current_process().name))
             odata = list()
             odata.append(did)
             odata.extend(stat)
-            output(dbconnstr, odata)
+            batch.append(odata)
+            if len(batch) >= batch_size:
+                sqlitedb.insert_stats(con, batch)
+                batch = list()
+                print_info ("%s output done ..." % (mp.current_process().name))
+        except Exception, e:
+            print_error("%s failed with: %s" %
+                        (mp.current_process().name, str(e)))
+    sqlitedb.insert_stats(con, batch)
+    con.close()
+    return True
+
+def server_worker(dbconnstr, queue):
+    print_log ("START server_worker")
+    con = connect(dbconnstr)
+    for table, datasets in iter(queue.get, 'DONE'):
+        try:
+            batch = get_stats_server(con, table, datasets)
+            print_info ("%s get_stats_server done ..." %
+                        (mp.current_process().name))
+            for i in range(0, len(batch), batch_size):
+                output(con, batch[i:i+batch_size])
             print_info ("%s output done ..." % (mp.current_process().name))
         except Exception, e:
             print_error("%s failed with: %s" %
                         (mp.current_process().name, e.message))
+    con.close()
     return True
 
-def output(dbconnstr, odata):
-    try:
-        con = psycopg2.connect(dbconnstr)
-    except Exception, e:
-        print_error("output: connecting to database")
-        print_error("failed with: %s" % ( e.message))
-        sys.exit(1)
+def output(con, batch):
+    from psycopg2.extras import execute_values
+    if len(batch) == 0:
+        return True
     cur = con.cursor()
-    insert_stat = "INSERT INTO t_origin_stats VALUES (%s,%s,%s,%s,%s,%s,%s,'%s')"
-    sql_insert = insert_stat % tuple(odata)
+    insert_stats = "INSERT INTO t_origin_stats VALUES %s"
+    insert_stat = "INSERT INTO t_origin_stats VALUES (%s,%s,%s,%s,%s,%s,%s,%s)"
     try:
-        print_info("output: insert stats")
-        cur.execute(sql_insert)
+        print_info("output: insert %d stats" % len(batch))
+        execute_values(cur, insert_stats, batch)
         con.commit()
     except Exception, e:
-        print_error("INSERT: %s ; failed with: %s" % (sql_insert, e.message))
+        print_error("INSERT: batch of %d stats ; failed with: %s" %
+                    (len(batch), e.message))
         con.rollback()
+        # retry row by row, so one bad row does not drop the whole batch
+        for odata in batch:
+            try:
+                cur.execute(insert_stat, odata)
+                con.commit()
+            except Exception, e:
+                print_error("INSERT: %s ; failed with: %s" %
+                            (';'.join(str(x) for x in odata), e.message))
+                con.rollback()
+            else:
+                print_info ("STAT: " + ';'.join( str(x) for x in odata))
     else:
-        print_info ("STAT: " + ';'.join( str(x) for x in odata))
+        for odata in batch:
+            print_info ("STAT: " + ';'.join( str(x) for x in odata))
     return True
 
 def main():
@@ -208,9 +327,11 @@ def main():
     parser.add_argument('-v', '--verbose',
                         help='print everything.',
                         action='store_true')
-    parser.add_argument('-p', '--postgres',
-                        help='Use PostgresqlDB for input and output.',
-                        required=True)
+    dbmode = parser.add_mutually_exclusive_group(required=True)
+    dbmode.add_argument('-p', '--postgres',
+                        help='Use PostgresqlDB for input and output.')
+    dbmode.add_argument('--sqlite',
+                        help='Use SQLite database file for input and output.')
     parser.add_argument('-b', '--begin',
                         help='Begin date (inclusive), format: yyyy-mm-dd',
                         type=valid_date, required=True)
@@ -226,6 +347,10 @@ def main():
     parser.add_argument('-n', '--numthreads',
                         help='Set number of threads.',
                         type=int, default=2)
+    parser.add_argument('--server-side',
+                        help='Compute aggregates in the database, one '
+                             'monthly partition per worker.',
+                        action='store_true')
     args = vars(parser.parse_args())
 
     global verbose
@@ -234,6 +359,8 @@ def main():
     warning   = args['warning']
     global logging
     logging   = args['logging']
+    global server_side
+    server_side = args['server_side']
 
     # run
     start_time = datetime.now()
@@ -251,36 +378,65 @@ def main():
     # prepare some vars
     input_queue = mp.Queue()
     # get all matching datasets
-    try:
-        con = psycopg2.connect(dbconnstr)
-    except Exception, e:
-        print_error("origin_ttl_postgres: connecting to database")
-        print_error("failed with: %s" % ( e.message))
-        sys.exit(1)
-    cur = con.cursor()
+    if args['sqlite']:
+        con = sqlitedb.connect(args['sqlite'])
+        datasets = OrderedDict(sqlitedb.get_datasets(con, begin, until,
+                                                     maptype, subtype,
+                                                     missing=True))
+        con.close()
+        if server_side:
+            print_warn("server side aggregates need Postgres, ignored.")
+            server_side = False
+    else:
+        try:
+            import psycopg2
+            con = psycopg2.connect(dbconnstr)
+        except Exception, e:
+            print_error("origin_ttl_postgres: connecting to database")
+            print_error("failed with: %s" % ( e.message))
+            sys.exit(1)
+        cur = con.cursor()
 
-    query_datasets = ("SELECT id, ts FROM t_datasets WHERE ts >= '%s' "
-                      "AND ts < '%s' AND maptype = '%s' "
-                      "AND subtype = '%s' ORDER BY ts")
-    datasets = OrderedDict()
-    query = query_datasets % (begin,until,maptype,subtype)
-    try:
-        cur.execute(query)
-        rs = cur.fetchall()
-        datasets = OrderedDict((row[0], row[1]) for row in rs)
-    except Exception, e:
-        print_error("QUERY: %s ; failed with: %s" % (query, e.message))
-        con.rollback()
+        # datasets that have no stats yet, anti-join against the results
+        query_datasets = ("SELECT d.id, d.ts FROM t_datasets AS d "
+                          "WHERE d.ts >= %s AND d.ts < %s AND d.maptype = %s "
+                          "AND d.subtype = %s AND NOT EXISTS "
+                          "(SELECT 1 FROM t_origin_stats AS s "
+                          "WHERE s.dataset_id = d.id) ORDER BY d.ts")
+        datasets = OrderedDict()
+        query = cur.mogrify(query_datasets, [begin,until,maptype,subtype])
+        try:
+            cur.execute(query)
+            rs = cur.fetchall()
+            datasets = OrderedDict((row[0], row[1]) for row in rs)
+        except Exception, e:
+            print_error("QUERY: %s ; failed with: %s" % (query, e.message))
+            con.rollback()
     print_log ("FOUND %s datasets." % str(len(datasets)))
-    # fill input_queue
+    # fill input_queue, with server side aggregates one month per item
     print_info ("fill input queue")
-    for i in datasets.items():
-        input_queue.put(i)
+    target = worker
+    if server_side:
+        target = server_worker
+        months = OrderedDict()
+        for did, ts in datasets.items():
+            table = "t_origins_" + ts.strftime("%Y_%m")
+            if table not in months:
+                months[table] = list()
+            months[table].append((did, ts))
+        for i in months.items():
+            input_queue.put(i)
+    else:
+        for i in datasets.items():
+            input_queue.put(i)
+    if args['sqlite']:
+        target = worker_sqlite
+        dbconnstr = args['sqlite']
     # start workers
     print_info("start workers")
     processes = []
     for w in xrange(workers):
-        p = mp.Process(target=worker,
+        p = mp.Process(target=target,
                        args=(dbconnstr,input_queue))
         p.start()
         processes.append(p)
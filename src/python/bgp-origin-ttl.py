@@ -8,18 +8,23 @@ import os
 import re
 import sys
 import json
-import psycopg2
+import StringIO
 
 from time import sleep
-from pymongo import MongoClient
 from datetime import datetime, timedelta
 from collections import OrderedDict
 from multiprocessing import Process, Queue, cpu_count, current_process
+# own imports
+import sqlitedb
+from pgorigins import iter_origins_range
 
 verbose = False
 warning = False
 logging = False
 
+# output rows are written and committed in batches of this size
+batch_size = 10000
+
 def print_log(*objs):
     if logging or verbose:
         print("[LOGS] .", *objs, file=sys.stdout)
@@ -42,10 +47,137 @@ def valid_date(s):
         msg = "Not a valid date: '{0}'.".format(s)
         raise argparse.ArgumentTypeError(msg)
 
-def origin_ttl_postgres(dbconnstr, outqeue, mints, maxts, mt, st):
-    print_log("CALL origin_ttl_postgres (%s,%s,%s,%s)" % (mints,maxts,mt,st))
+def to_epoch(dt):
+    return int((dt - datetime(1970, 1, 1)).total_seconds())
+
+def from_epoch(ts):
+    return datetime.utcfromtimestamp(ts)
+
+class OriginTracker(object):
+    # prefix origin associations alive in the last dataset, with the epoch
+    # they were first seen; updates only touch associations that appear or
+    # disappear between two consecutive datasets
+
+    def __init__(self, maptype=None, subtype=None, shard=None):
+        self.maptype = maptype
+        self.subtype = subtype
+        self.shard = shard
+        self.first = dict()
+        self.last = None
+
+    def __len__(self):
+        return len(self.first)
+
+    def update(self, ts, pairs):
+        # returns the associations that ended as (prefix, asn, ts0, ts1)
+        ended = list()
+        for k in self.first.viewkeys() - pairs:
+            ended.append((k[0], k[1], self.first.pop(k), self.last))
+        for k in pairs - self.first.viewkeys():
+            self.first[k] = ts
+        self.last = ts
+        return ended
+
+    def close(self):
+        # ends all associations still alive at the last dataset
+        ended = [(k[0], k[1], ts0, self.last)
+                 for k, ts0 in self.first.iteritems()]
+        self.first = dict()
+        return ended
+
+    def save(self, fname):
+        data = {'maptype' : self.maptype,
+                'subtype' : self.subtype,
+                'shard' : self.shard,
+                'last' : self.last,
+                'origins' : [[k[0], k[1], ts0]
+                             for k, ts0 in self.first.iteritems()]}
+        tmp = fname + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.rename(tmp, fname)
+
+    @classmethod
+    def load(cls, fname):
+        with open(fname, "r") as f:
+            data = json.load(f)
+        shard = data.get('shard')
+        if shard:
+            shard = tuple(shard)
+        tracker = cls(data['maptype'], data['subtype'], shard)
+        tracker.last = data['last']
+        tracker.first = dict(((o[0], o[1]), o[2]) for o in data['origins'])
+        return tracker
+
+def output_ended(outqeue, ended):
+    for pfx, asn, ts0, ts1 in ended:
+        ttl = ts1 - ts0
+        if ttl > 0:
+            res = (pfx,asn,str(from_epoch(ts0)),str(from_epoch(ts1)),ttl)
+            outqeue.put(res)
+
+def shardName(fname, shard):
+    # per shard checkpoint, the plain name if not sharded
+    if not shard:
+        return fname
+    return "%s.%d-of-%d" % (fname, shard[0], shard[1])
+
+def openTracker(checkpoint, mt, st, shard):
+    tracker = OriginTracker(mt, st, shard)
+    if checkpoint and os.path.isfile(checkpoint):
+        try:
+            tracker = OriginTracker.load(checkpoint)
+        except (IOError, ValueError, KeyError), e:
+            print_error("loading checkpoint %s failed with: %s" %
+                        (checkpoint, str(e)))
+            sys.exit(1)
+        if (tracker.maptype != mt) or (tracker.subtype != st) or \
+                (tracker.shard != shard):
+            print_error("checkpoint %s is for %s %s, shard %s" %
+                        (checkpoint, tracker.maptype, tracker.subtype,
+                         str(tracker.shard)))
+            sys.exit(1)
+        print_log("RESUME with %d origins at %s" %
+                  (len(tracker), str(tracker.last)))
+    return tracker
+
+def runTracker(tracker, outqeue, loaded, checkpoint, close):
+    cnt = 0
+    try:
+        for did, ts_str, ptree in loaded:
+            cnt = cnt+1
+            print_info("RUN %s, processing did: %s, dts: %s" %
+                        (cnt, did, ts_str))
+            pairs = set((pfx, asn) for pfx in ptree for asn in ptree[pfx])
+            output_ended(outqeue, tracker.update(to_epoch(ts_str), pairs))
+    except Exception, e:
+        # origins are not closed on missing datasets, a checkpoint keeps
+        # them to continue after the last dataset done
+        print_error("runTracker: stopped after %d datasets, failed with: %s" %
+                    (cnt, str(e)))
+        if checkpoint:
+            tracker.save(checkpoint)
+            print_log("CHECKPOINT with %d origins" % (len(tracker)))
+        return False
+    if checkpoint and not close:
+        # origins still alive are carried over to the next run
+        tracker.save(checkpoint)
+        print_log("CHECKPOINT with %d origins" % (len(tracker)))
+    else:
+        output_ended(outqeue, tracker.close())
+
+def origin_ttl_postgres(dbconnstr, outqeue, mints, maxts, mt, st,
+                        checkpoint=None, close=True, shard=None):
+    print_log("CALL origin_ttl_postgres (%s,%s,%s,%s,%s)" %
+              (mints,maxts,mt,st,str(shard)))
+    checkpoint = checkpoint and shardName(checkpoint, shard)
+    tracker = openTracker(checkpoint, mt, st, shard)
+    if tracker.last is not None:
+        # continue right after the last dataset of the previous run
+        mints = max(mints, from_epoch(tracker.last))
     print_info(dbconnstr)
     try:
+        import psycopg2
         con = psycopg2.connect(dbconnstr)
     except Exception, e:
         print_error("origin_ttl_postgres: connecting to database")
@@ -56,9 +188,6 @@ def origin_ttl_postgres(dbconnstr, outqeue, mints, maxts, mt, st):
     query_datasets = ("SELECT id, ts FROM t_datasets WHERE ts >= '%s' "
                       "AND ts < '%s' AND maptype = '%s' "
                       "AND subtype = '%s' ORDER BY ts")
-    query_origins = ("SELECT p.prefix, o.asn FROM "
-                     "(SELECT * FROM %s WHERE dataset_id = '%s') AS o "
-                     "LEFT JOIN t_prefixes AS p ON o.prefix_id = p.id")
 
     datasets = OrderedDict()
     try:
@@ -69,70 +198,80 @@ def origin_ttl_postgres(dbconnstr, outqeue, mints, maxts, mt, st):
     except Exception, e:
         print_error("QUERY: %s ; failed with: %s" % (query, e.message))
         con.rollback()
+    con.close()
     print_log ("FOUND %s datasets." % str(len(datasets)))
-    origins = dict()
-    cnt = 0
-    for did in datasets:
-        cnt = cnt+1
-        print_info("RUN %s, processing did: %s, dts: %s" %
-                    (cnt, did, datasets[did]))
-        ts_str = datasets[did]
-        ym_str = ts_str.strftime("%Y_%m")
-        table = "t_origins_"+ym_str
-        #ts = (datetime.strptime(ts_str, "%Y-%m-%d %H:%M:%S") -
-        #            datetime(1970, 1, 1)).total_seconds()
-        ts = (ts_str - datetime(1970, 1, 1)).total_seconds()
-        # get origins of dataset
-        try:
-            query = query_origins % (table, did)
-            cur.execute(query)
-            rs = cur.fetchall()
-        except Exception, e:
-            print_error("QUERY: %s ; failed with: %s" % (query, e.message))
-            con.rollback()
-        else:
-            # update timestamps of prefix origin association
-            for row in rs:
-                pfx = str(row[0])
-                asn = int(row[1])
-                if pfx not in origins:
-                    origins[pfx] = dict()
-                if asn not in origins[pfx]:
-                    val = (ts_str,ts_str)
-                    origins[pfx][asn] = val
-                else:
-                    old = origins[pfx][asn]
-                    val = (old[0],ts_str)
-                    origins[pfx][asn] = val
-            # check prefix origin association, output and delete old ones
-            delorigin = list()
-            for pfx in origins:
-                for asn in origins[pfx]:
-                    val = origins[pfx][asn]
-                    if val[1] != ts_str:
-                        ts0 = (val[0] - datetime(1970, 1, 1)).total_seconds()
-                        ts1 = (val[1] - datetime(1970, 1, 1)).total_seconds()
-                        ttl = int(ts1 - ts0)
-                        if ttl > 0:
-                            res = (pfx,asn,str(val[0]),str(val[1]),ttl)
-                            outqeue.put(res)
-                        dl = (pfx, asn)
-                        delorigin.append(dl)
-            for d in delorigin:
-                pfx = d[0]
-                asn = d[1]
-                del origins[pfx][asn]
-    for pfx in origins:
-        for asn in origins[pfx]:
-            val = origins[pfx][asn]
-            ts0 = (val[0] - datetime(1970, 1, 1)).total_seconds()
-            ts1 = (val[1] - datetime(1970, 1, 1)).total_seconds()
-            ttl = int(ts1 - ts0)
-            if ttl > 0:
-                res = (pfx,asn,str(val[0]),str(val[1]),ttl)
-                outqeue.put(res)
+    if tracker.last is not None:
+        datasets = OrderedDict((did, ts) for did, ts in datasets.items()
+                               if to_epoch(ts) > tracker.last)
+    # origins of all datasets are streamed per month, in order of ts
+    loaded = iter_origins_range(dbconnstr, datasets.items(), shard=shard)
+    runTracker(tracker, outqeue, loaded, checkpoint, close)
+    return True
+
+def origin_ttl_sqlite(fname, outqeue, mints, maxts, mt, st,
+                      checkpoint=None, close=True, shard=None):
+    print_log("CALL origin_ttl_sqlite (%s,%s,%s,%s,%s)" %
+              (mints,maxts,mt,st,str(shard)))
+    checkpoint = checkpoint and shardName(checkpoint, shard)
+    tracker = openTracker(checkpoint, mt, st, shard)
+    if tracker.last is not None:
+        mints = max(mints, from_epoch(tracker.last))
+    con = sqlitedb.connect(fname)
+    datasets = sqlitedb.get_datasets(con, mints, maxts, mt, st)
+    print_log ("FOUND %s datasets." % str(len(datasets)))
+    if tracker.last is not None:
+        datasets = [(did, ts) for did, ts in datasets
+                    if to_epoch(ts) > tracker.last]
+    loaded = sqlitedb.iter_origins(con, datasets, shard)
+    runTracker(tracker, outqeue, loaded, checkpoint, close)
+    con.close()
     return True
 
+def resolvePrefixes(cur, prefix_ids, prefixes):
+    # ids of prefixes not cached yet, missing ones are inserted unless a
+    # concurrent writer did so (unique prefix), then all are looked up.
+    # Sorted, so concurrent writers lock the same prefixes in the same order.
+    create_staging = ("CREATE TEMP TABLE IF NOT EXISTS tmp_prefixes "
+                      "(prefix INET)")
+    insert_staged = ("INSERT INTO t_prefixes (prefix) "
+                     "SELECT DISTINCT prefix FROM tmp_prefixes "
+                     "ORDER BY prefix ON CONFLICT (prefix) DO NOTHING")
+    # separate statement, so it sees rows committed while we waited
+    query_resolve = ("SELECT p.prefix, p.id FROM t_prefixes AS p "
+                     "JOIN tmp_prefixes AS t ON p.prefix = t.prefix")
+    cur.execute(create_staging)
+    cur.execute("TRUNCATE tmp_prefixes")
+    f_pfx = StringIO.StringIO('\n'.join(prefixes))
+    cur.copy_from(f_pfx, 'tmp_prefixes', columns=('prefix',))
+    cur.execute(insert_staged)
+    cur.execute(query_resolve)
+    for pfx, pid in cur:
+        prefix_ids[pfx] = pid
+
+def outputBatch(con, oid, prefix_ids, batch):
+    # resolve unknown prefixes once, then COPY all rows of the batch
+    cur = con.cursor()
+    try:
+        missing = set(odata[0] for odata in batch
+                      if odata[0] not in prefix_ids)
+        if missing:
+            resolvePrefixes(cur, prefix_ids, missing)
+        rows = list()
+        for odata in batch:
+            pid = prefix_ids.get(odata[0], 0)
+            if pid > 0:
+                rows.append("%d\t%d\t%s\t%s\t%s\t%d\n" %
+                            (oid, pid, odata[1], odata[2], odata[3], odata[4]))
+            else:
+                print_warn("Invalid ID for prefix %s" % (odata[0]))
+        cur.copy_from(StringIO.StringIO(''.join(rows)), 't_origin_ttl_data')
+        con.commit()
+        print_info("output: copied %d ttl rows" % (len(rows)))
+    except Exception, e:
+        print_error("COPY t_origin_ttl_data batch of %d failed with: %s" %
+                    (len(batch), e.message))
+        con.rollback()
+
 def output_thread(outqeue, opts):
     print_log("CALL output_thread")
     oid = 0
@@ -154,6 +293,7 @@ def output_thread(outqeue, opts):
     elif opts[0] == 'postgres':
         dbconnstr = opts[1]
         try:
+            import psycopg2
             con = psycopg2.connect(dbconnstr)
         except Exception, e:
             print_error("retrieve_postgres: connecting to database")
@@ -163,10 +303,6 @@ def output_thread(outqeue, opts):
         insert_origin = ("INSERT INTO t_origin_ttl "
                       "(ts_begin, ts_until, maptype, subtype)"
                       " VALUES (%s, %s, %s, %s) RETURNING id")
-        insert_data = ("INSERT INTO t_origin_ttl_data "
-                           "VALUES (%s,%s,%s,%s,%s,%s)")
-        query_prefix = "SELECT id FROM t_prefixes WHERE prefix = %s"
-        insert_prefix = "INSERT INTO t_prefixes (prefix) VALUES (%s) RETURNING id"
         try:
             cur.execute(insert_origin, [opts[2].strftime('%Y-%m-%d'),
                                         opts[3].strftime('%Y-%m-%d'),
@@ -191,6 +327,9 @@ def output_thread(outqeue, opts):
         except Exception, e:
             print_error("QUERY t_prefixes (1) failed with: %s" % (e.message))
             con.rollback()
+    elif opts[0] == 'sqlite':
+        con = sqlitedb.connect(opts[1])
+        oid = sqlitedb.new_ttl(con, opts[2], opts[3], opts[4], opts[5])
     elif opts[0] == 'mongodb':
         print_error("Not implemented yet! How did you even get here?!")
         sys.exit(1)
@@ -208,51 +347,39 @@ def output_thread(outqeue, opts):
         f.write(header)
         f.flush()
 
-    # output queue data
+    # output queue data, files get large writes and a flush per batch
     first = True
+    batch = list()
     while True:
         odata = outqeue.get()
-        if (odata == 'DONE'):
-            print_log("EXIT output_thread")
-            break
+        if (odata != 'DONE'):
+            batch.append(odata)
+            if len(batch) < batch_size:
+                continue
         if opts[0] == 'json':
-            if not first:
-                f.write(",\n")
-            else:
+            if batch:
+                if not first:
+                    f.write(",\n")
                 first = False
-            f.write(json.dumps(odata))
-            f.flush()
+                f.write(",\n".join(json.dumps(o) for o in batch))
+                f.flush()
         elif opts[0] == 'postgres':
-            pid = 0
-            pfx = odata[0]
-            if pfx in prefix_ids:
-                pid = prefix_ids[pfx]
-            else:
-                try:
-                    cur.execute(insert_prefix, [pfx])
-                    con.commit()
-                    pid = cur.fetchone()
-                except Exception, e:
-                    print_error("INSERT t_prefixes failed with: %s" % (e.message))
-                    con.rollback()
-
-            if pid > 0:
-                try:
-                    cur.execute(insert_data,
-                                [oid,pid,odata[1],odata[2],odata[3],odata[4]])
-                    con.commit()
-                except Exception, e:
-                    print_error("INSERT t_origin_ttl failed with: %s" % (e.message))
-                    con.rollback()
-            else:
-                print_warn("Invalid ID for prefix %s" % (pfx))
-
+            if batch:
+                outputBatch(con, oid, prefix_ids, batch)
+        elif opts[0] == 'sqlite':
+            if batch:
+                sqlitedb.insert_ttl(con, oid, batch)
         elif opts[0] == 'mongodb':
             print_error("WTF? Still not implemented yet! How'd u get here?")
             sys.exit(1)
         else:
-            f.write(';'.join(str(x) for x in odata) + "\n")
+            f.write(''.join(';'.join(str(x) for x in o) + "\n"
+                            for o in batch))
             f.flush()
+        batch = list()
+        if (odata == 'DONE'):
+            print_log("EXIT output_thread")
+            break
 
     # finalize output
     if opts[0] == 'json':
@@ -286,6 +413,9 @@ def main():
     imode.add_argument('-p', '--postgres',
                         help='Read from PostgresqlDB.',
                         type=str)
+    imode.add_argument('--sqlite',
+                        help='Read from SQLite database file.',
+                        type=str)
 
     omode = parser.add_mutually_exclusive_group(required=False)
     omode.add_argument('-c', '--csv',
@@ -312,6 +442,18 @@ def main():
     parser.add_argument('-s', '--subtype',
                         help='Subtype of data source (show all: ?)',
                         type=str, default="route-views.eqix")
+    parser.add_argument('-n', '--numthreads',
+                        help='Split prefixes into this many shards, each '
+                             'tracked by its own process.',
+                        type=int, default=1)
+    parser.add_argument('--checkpoint',
+                        help='Resume from and save tracker state to file, '
+                             'origins alive at the end are not output.',
+                        type=str, default=None)
+    parser.add_argument('--close',
+                        help='With --checkpoint, output origins alive at '
+                             'the end and do not save the state.',
+                        action='store_true')
     args = vars(parser.parse_args())
 
     # output settings
@@ -338,6 +480,9 @@ def main():
         if args['postgres']:
             oopts = ('postgres', args['postgres'],
                      begin, until, maptype, subtype)
+        elif args['sqlite']:
+            oopts = ('sqlite', args['sqlite'],
+                     begin, until, maptype, subtype)
         elif args['mongodb']:
             oopts = ('mongodb', args['mongodb'],
                      begin, until, maptype, subtype)
@@ -345,18 +490,37 @@ def main():
     # start output process to
     output_queue = Queue()
 
-    if args['postgres']:
-        main_p = Process(target=origin_ttl_postgres,
-                         args=(args['postgres'], output_queue,
-                               begin, until, maptype, subtype))
+    workers = args['numthreads']
+    if not workers:
+        workers = max(cpu_count() / 2, 1)
+    # shards are tracked independently, all results go to one output
+    main_ps = list()
+    if args['postgres'] or args['sqlite']:
+        source = args['postgres']
+        target = origin_ttl_postgres
+        if args['sqlite']:
+            source = args['sqlite']
+            target = origin_ttl_sqlite
+        for k in xrange(workers):
+            shard = (k, workers) if workers > 1 else None
+            main_p = Process(target=target,
+                             args=(source, output_queue,
+                                   begin, until, maptype, subtype,
+                                   args['checkpoint'],
+                                   (not args['checkpoint']) or args['close'],
+                                   shard))
+            main_ps.append(main_p)
     else:
         print_error('No valid data source found!')
+        sys.exit(1)
 
-    main_p.start()
+    for main_p in main_ps:
+        main_p.start()
     output_p = Process(target=output_thread,
                        args=(output_queue, oopts))
     output_p.start()
-    main_p.join()
+    for main_p in main_ps:
+        main_p.join()
     output_queue.put('DONE')
     output_p.join()
     end_time = datetime.now()
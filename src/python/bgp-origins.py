@@ -8,14 +8,20 @@ import os
 import re
 import sys
 import json
-import psycopg2
 import StringIO
 import multiprocessing as mp
+from array import array
 from bz2 import BZ2File
+from struct import pack
 from datetime import datetime, timedelta
 #from pyasn import mrtx
 # own imports
 import mrtx
+from catalog import find_files
+from manifest import Manifest
+from prefetch import prefetch
+from jsonarchive import ArchiveWriter
+import sqlitedb
 
 verbose = False
 warning = False
@@ -27,9 +33,42 @@ re_file_rr = re.compile('bview.(\d+).(\d\d\d\d).gz')
 re_path_rv = re.compile('.*/([a-z0-9\.-]+)/bgpdata/\d\d\d\d.\d\d/RIBS.*')
 re_path_rr = re.compile('.*/(rrc\d\d)/\d\d\d\d.\d\d.*')
 
-existing_data = list()
+# (ts, maptype, subtype) of datasets already in the database, ts as
+# written to t_datasets
+existing_data = set()
 
+# re-ingest datasets already in the database, replacing their origins
+replace = False
+
+resume = Manifest()
+
+# (ts, maptype, subtype) of files found through the catalog
+file_info = dict()
+
+# prefix -> id cache of t_prefixes, lives as long as the process. It is
+# filled once, prefixes missing later are resolved by insertPrefixes.
 prefix_ids = dict()
+prefix_ids_loaded = False
+
+# database connection of this process, reused for all datasets
+db_con = None
+sqlite_con = None
+
+# open JSON archive writers of this process, by file name
+json_archives = dict()
+
+# use binary instead of text format for COPY of origins
+copy_binary = False
+
+# load origins into unindexed t_origins_YYYY_MM_staging tables, which
+# get their keys and are swapped in by finalizeStaging at the end, as
+# partition of the month or as child table of an existing one
+staging = False
+
+# (maptype, subtype) -> [ts_last, set of (prefix_id, asn)] of the origin
+# intervals still open, loaded from the database on first use
+open_intervals = dict()
+
 def print_log(*objs):
     if logging or verbose:
         print("[LOGS] .", *objs, file=sys.stdout)
@@ -45,29 +84,58 @@ def print_warn(*objs):
 def print_error(*objs):
     print("[ERROR] ", *objs, file=sys.stderr)
 
+def valid_date(s):
+    try:
+        return datetime.strptime(s, "%Y-%m-%d")
+    except ValueError:
+        msg = "Not a valid date: '{0}'.".format(s)
+        raise argparse.ArgumentTypeError(msg)
+
 def parseOrigins(fin):
     print_log("call parseOrigins (%s)"  % (fin))
     f = (BZ2File(fin, 'rb'), gzip.open(fin, 'rb'))[fin.lower().endswith('.gz')]
     data = mrtx.parse_mrt_file(f, print_progress=verbose)
     f.close()
-    pfxo = list()
-    for prefix, origins in data.items():
-        pfx = dict()
-        pfx['prefix'] = prefix
-        pfx['origins'] = list()
-        for o in list(origins):
-            if isinstance(o, set) or isinstance(o,list):
-                for osub in list(o):
-                    if str(osub) not in pfx['origins']:
-                        pfx['origins'].append(str(osub))
-            else:
-                if str(o) not in pfx['origins']:
-                    pfx['origins'].append(str(o))
-        pfxo.append(pfx)
-    return pfxo
+    return buildOrigins(data)
+
+def buildOrigins(data):
+    # origins of already parsed MRT data, see also bgp-pipeline
+    # compact layout (prefixes, offsets, asns): origin ASNs of prefixes[i]
+    # are asns[offsets[i]:offsets[i+1]], see iterOrigins
+    prefixes = list()
+    offsets = array('I', [0])
+    asns = array('I')
+    for prefix, origins in data.iteritems():
+        seen = set()
+        for o in origins:
+            if not (isinstance(o, set) or isinstance(o,list)):
+                o = (o,)
+            for osub in o:
+                if osub not in seen:
+                    seen.add(osub)
+                    asns.append(osub)
+        prefixes.append(prefix)
+        offsets.append(len(asns))
+    return prefixes, offsets, asns
+
+def iterOrigins(origins):
+    # (prefix, origin ASNs) of the compact layout of parseOrigins
+    prefixes, offsets, asns = origins
+    for i in xrange(len(prefixes)):
+        yield prefixes[i], asns[offsets[i]:offsets[i+1]]
+
+def originsJSON(data):
+    # data with origins in the {prefix, origins} shape of the JSON output
+    jdata = dict(data)
+    jdata['origins'] = [{'prefix' : prefix,
+                         'origins' : [str(a) for a in asns]}
+                        for prefix, asns in iterOrigins(data['origins'])]
+    return jdata
 
 def parseFilename(fin):
     print_log("call parseFilename (%s)" % (fin))
+    if fin in file_info:
+        return file_info[fin]
 
     maptype = 'none'
     subtype = 'none'
@@ -104,6 +172,31 @@ def parseFilename(fin):
              datetime(1970, 1, 1)).total_seconds())
     return ts, maptype, subtype
 
+def isDone(fin):
+    ts, mt, st = parseFilename(fin)
+    ts_str = datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')
+    if (ts_str, mt, st) in existing_data:
+        return True
+    return resume.done(mt, st, ts, 'origins', fin)
+
+def loadExistingData(dbconnstr):
+    query_datasets = "SELECT ts, maptype, subtype FROM t_datasets"
+    try:
+        import psycopg2
+        con = psycopg2.connect(dbconnstr)
+        cur = con.cursor()
+        cur.execute(query_datasets)
+        for ts, mt, st in cur:
+            existing_data.add((ts.strftime('%Y-%m-%d %H:%M:%S'), mt, st))
+        con.close()
+    except Exception, e:
+        print_error("QUERY t_datasets failed with: %s" % (e.message))
+    print_log("read %d data sets." % (len(existing_data)))
+
+def markDone(fin):
+    ts, mt, st = parseFilename(fin)
+    resume.mark(mt, st, ts, 'origins', fin)
+
 def worker(fin):
     ts0, mt0, st0 = parseFilename(fin)
     origins = parseOrigins(fin)
@@ -114,15 +207,27 @@ def worker(fin):
     data['origins'] = origins
     return data
 
-def workerThread(inq,outq):
+def writerIndex(ts, writers):
+    # datasets of one monthly partition always go to the same writer
+    dt = datetime.fromtimestamp(ts)
+    return (dt.year * 12 + dt.month) % writers
+
+def workerThread(inq,outqs,opts=None):
     print_log("start workerThread")
     for fin in iter(inq.get, 'DONE'):
         try:
             data = worker(fin)
-            outq.put(data)
+            if outqs is None:
+                # direct mode, write to own sink and skip the output process
+                output(data, opts)
+                markDone(fin)
+            else:
+                i = writerIndex(data['timestamp'], len(outqs))
+                outqs[i].put((fin, data))
         except Exception, e:
             print_error("%s failed with: %s" %
                         (mp.current_process().name, e.message))
+    closeArchives()
     return True
 
 def output(data, opts):
@@ -130,52 +235,196 @@ def output(data, opts):
         outputJSON(data, opts['params'])
     elif opts['output'] == 'postgres':
         outputPostgres(data, opts['params'])
+    elif opts['output'] == 'intervals':
+        outputIntervals(data, opts['params'])
+    elif opts['output'] == 'sqlite':
+        outputSQLite(data, opts['params'])
     elif opts['output']:
         print_info ("using %s with params %s." %
                     (opts['database'],opts['params']))
     else:
         outputStdout(data)
 
+def shardName(fout, n):
+    if fout.lower().endswith('.gz'):
+        fout = fout[:-3]
+    return "%s.%d.gz" % (fout, n)
+
+def getConnection(dbconnstr):
+    global db_con
+    if (db_con is None) or db_con.closed:
+        import psycopg2
+        db_con = psycopg2.connect(dbconnstr)
+    return db_con
+
+def prefixKey(prefix):
+    # host prefixes come back from postgres without mask
+    if (':' not in prefix) and prefix.endswith('/32'):
+        return prefix[:-3]
+    if (':' in prefix) and prefix.endswith('/128'):
+        return prefix[:-4]
+    return prefix
+
+def loadPrefixIds(cur):
+    # all prefix ids known so far, once per process. No high-water mark on
+    # the id for later syncs: ids of concurrent transactions commit out of
+    # order, so prefixes of other writers are looked up by insertPrefixes.
+    global prefix_ids_loaded
+    if prefix_ids_loaded:
+        return
+    cur.execute("SELECT prefix, id FROM t_prefixes")
+    for pfx, pid in cur:
+        prefix_ids[pfx] = pid
+    prefix_ids_loaded = True
+    print_info("loaded %d prefix ids" % (len(prefix_ids)))
+
+def insertPrefixes(cur, prefixes):
+    # stage new prefixes, add those other workers did not add yet and read
+    # back the ids of all of them, the unique prefix decides who wins.
+    # Sorted, so concurrent writers lock the same prefixes in the same order.
+    create_staging = ("CREATE TEMP TABLE IF NOT EXISTS tmp_prefixes "
+                      "(prefix INET)")
+    insert_staged = ("INSERT INTO t_prefixes (prefix) "
+                     "SELECT DISTINCT prefix FROM tmp_prefixes "
+                     "ORDER BY prefix ON CONFLICT (prefix) DO NOTHING")
+    # separate statement, so it sees rows committed while we waited
+    query_staged = ("SELECT p.prefix, p.id FROM t_prefixes AS p "
+                    "JOIN tmp_prefixes AS t ON p.prefix = t.prefix")
+    cur.execute(create_staging)
+    cur.execute("TRUNCATE tmp_prefixes")
+    f_pfx = StringIO.StringIO('\n'.join(prefixes))
+    cur.copy_from(f_pfx, 'tmp_prefixes', columns=('prefix',))
+    cur.execute(insert_staged)
+    cur.execute(query_staged)
+    for pfx, pid in cur:
+        prefix_ids[pfx] = pid
+
+class IteratorFile(object):
+    # file-like reader over a generator of strings, feeds COPY ... FROM STDIN
+    # while the rows are still being produced
+    def __init__(self, it):
+        self.it = it
+        self.buf = ''
+
+    def read(self, size=-1):
+        while (size < 0) or (len(self.buf) < size):
+            try:
+                self.buf += next(self.it)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self.buf)
+        ret = self.buf[:size]
+        self.buf = self.buf[size:]
+        return ret
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+def copyRows(did, origins, binary=False):
+    # rows of (dataset_id, prefix_id, asn) in text or binary COPY format
+    if binary:
+        yield 'PGCOPY\n\377\r\n\0' + pack('>ii', 0, 0)
+    rows = list()
+    for prefix, asns in iterOrigins(origins):
+        pid = prefix_ids.get(prefixKey(prefix), 0)
+        if pid > 0:
+            for a in asns:
+                if a > 0:
+                    if binary:
+                        rows.append(pack('>hiiiiii', 3, 4, did, 4, pid,
+                                         4, a))
+                    else:
+                        rows.append("%d\t%d\t%d\n" % (did, pid, a))
+        if len(rows) > 1000:
+            yield ''.join(rows)
+            rows = list()
+    if binary:
+        rows.append(pack('>h', -1))
+    yield ''.join(rows)
+
 def outputJSON(data,fout):
+    # one gzip member per dataset, indexed in <fout>.idx for seeking
     try:
         if not fout.lower().endswith('.gz'):
             fout = fout+".gz"
-        with gzip.open(fout, "ab") as f:
-            f.write(json.dumps(data)+'\n')
+        if fout not in json_archives:
+            json_archives[fout] = ArchiveWriter(fout)
+        json_archives[fout].write(data['maptype'], data['subtype'],
+                                  data['timestamp'], originsJSON(data))
     except:
         print_error("Failed to write data as JSON to file %s." % (fout))
 
-def outputPostgres(data,dbconnstr):
-    print_info(dbconnstr)
-    try:
-        con = psycopg2.connect(dbconnstr)
-    except Exception, e:
-        print_error("%s failed with: %s" % (mp.current_process().name, e.message))
-        print_error("outputPG: connecting to database")
-        sys.exit(1)
+def closeArchives():
+    # finish the gzip members and index of all JSON archives written
+    for archive in json_archives.values():
+        archive.close()
+    json_archives.clear()
 
-    cur = con.cursor()
+def getDataset(cur, ts_str, maptype, subtype):
+    # id of the dataset, created if not existing. Not committed here, so a
+    # new dataset is only registered together with its origins.
     query_dataset = "SELECT id FROM t_datasets " \
                     "WHERE ts = %s AND  maptype = %s AND subtype = %s"
     insert_dataset = "INSERT INTO t_datasets (ts, maptype, subtype) " \
                      "VALUES (%s,%s,%s) RETURNING id"
-    query_prefix = "SELECT id FROM t_prefixes WHERE prefix = %s"
-    insert_prefix = "INSERT INTO t_prefixes (prefix) VALUES (%s) RETURNING id"
-    insert_origin = "INSERT INTO t_origins VALUES (%s,%s,%s)"
+    cur.execute(query_dataset, [ts_str,maptype,subtype])
+    row = cur.fetchone()
+    if row is None:
+        # dataset does not exists, so create and fill it up
+        cur.execute(insert_dataset, [ts_str,maptype,subtype])
+        row = cur.fetchone()
+    return row[0]
 
-    # get all prefixes already in database
-    query_all_prefixes = "SELECT prefix, id FROM t_prefixes"
-    prefix_ids = dict()
+def updatePrefixIds(con, cur, origins):
+    # make sure all prefixes of origins are in the database and the cache
+    query_prefix = "SELECT id FROM t_prefixes WHERE prefix = %s"
+    insert_prefix = ("INSERT INTO t_prefixes (prefix) VALUES (%s) "
+                     "ON CONFLICT (prefix) DO NOTHING")
+    # prefixes added by other workers since are resolved with the new ones
     try:
-        cur.execute(query_all_prefixes)
-        pfx = cur.fetchall()
-        prefix_ids = dict((pfx[i][0], pfx[i][1]) for i in range(len(pfx)))
+        loadPrefixIds(cur)
     except Exception, e:
         print_error("QUERY t_prefixes (1) failed with: %s" % (e.message))
         con.rollback()
+    prefix_new = set()
+    # find prefixes not in database
+    for prefix in origins[0]:
+        if prefixKey(prefix) not in prefix_ids:
+            prefix_new.add(prefix)
+    # write new prefixes to database and add their ids to the cache
+    if len(prefix_new) > 0:
+        print_log("#new prefixes: %s" % (str(len(prefix_new))))
+        try:
+            insertPrefixes(cur, prefix_new)
+            con.commit()
+        except Exception, e:
+            print_error("INSERT INTO t_prefixes failed with: %s" % (e.message))
+            con.rollback()
+    # resolve prefixes still missing, cursor is busy once COPY runs
+    for ptmp in prefix_new:
+        if prefixKey(ptmp) in prefix_ids:
+            continue
+        try:
+            cur.execute(insert_prefix, [ptmp])
+            con.commit()
+            cur.execute(query_prefix, [ptmp])
+            prefix_ids[prefixKey(ptmp)] = cur.fetchone()[0]
+        except Exception, e:
+            print_error("resolve prefix %s failed with: %s" % (ptmp, e.message))
+            con.rollback()
+
+def outputPostgres(data,dbconnstr):
+    print_info(dbconnstr)
+    try:
+        con = getConnection(dbconnstr)
+    except Exception, e:
+        print_error("%s failed with: %s" % (mp.current_process().name, e.message))
+        print_error("outputPG: connecting to database")
+        sys.exit(1)
 
+    cur = con.cursor()
     # create new dataset object in database, if not existing
-    did = 0
     ts_str = datetime.fromtimestamp(
                 data['timestamp']).strftime('%Y-%m-%d %H:%M:%S')
     ts_year = ts_str.split('-')[0]
@@ -184,6 +433,10 @@ def outputPostgres(data,dbconnstr):
     create_table_ym = ( "CREATE TABLE IF NOT EXISTS " +
                         t_origins_ym + " () " +
                         "INHERITS (t_origins)")
+    if staging:
+        t_origins_ym += "_staging"
+        create_table_ym = ( "CREATE TABLE IF NOT EXISTS " +
+                            t_origins_ym + " (LIKE t_origins)")
     try:
         cur.execute(create_table_ym)
         con.commit()
@@ -191,82 +444,188 @@ def outputPostgres(data,dbconnstr):
         print_error("Error creating table (%s), failed with %s" %
                     (t_origins_ym, e.message))
         con.rollback()
+    origins = data['origins']
+    updatePrefixIds(con, cur, origins)
+    # insert all origins into database, streamed while rows are formatted;
+    # a new dataset row is committed with them or not at all
     try:
-        cur.execute(query_dataset, [ts_str,data['maptype'],data['subtype']])
-        did = cur.fetchone()[0]
-    except:
-        # dataset does not exists, so create and fill it up
-        con.rollback()
-        cur.execute(insert_dataset, [ts_str,data['maptype'],data['subtype']])
+        did = getDataset(cur, ts_str, data['maptype'], data['subtype'])
+        if not (int(did) > 0):
+            con.rollback()
+            return
+        if replace:
+            # drop whatever a previous run loaded, committed with the COPY
+            delete_origins = "DELETE FROM %s WHERE dataset_id = %%s"
+            cur.execute(delete_origins % "t_origins", [did])
+            if staging:
+                cur.execute(delete_origins % t_origins_ym, [did])
+        copy_from_stdin = "COPY %s FROM STDIN"
+        if copy_binary:
+            copy_from_stdin += " WITH (FORMAT binary)"
+        f = IteratorFile(copyRows(int(did), origins, copy_binary))
+        cur.copy_expert(sql=copy_from_stdin % t_origins_ym, file=f)
         con.commit()
-        did = cur.fetchone()[0]
-    origins = data['origins']
-    prefix_new = set()
-    # find prefixes not in database
-    for p in origins:
-        pid = 0
-        ptmp = p['prefix']
-        if ptmp.endswith('/32'):
-            ptmp = p['prefix'][:-3]
-        if ptmp not in prefix_ids:
-            prefix_new.add(p['prefix'])
-    # write new prefixes to database
-    if len(prefix_new) > 0:
-        print_log("#new prefixes: %s" % (str(len(prefix_new))))
-        pfx_str = '\n'.join(x for x in prefix_new)
-        f_pfx = StringIO.StringIO(pfx_str)
+    except Exception, e:
+        print_error("COPY t_origins FROM STDIN failed with: %s" %
+                    (e.message))
+        con.rollback()
+
+def loadOpenIntervals(cur, maptype, subtype):
+    query_last = ("SELECT ts_last FROM t_origin_intervals_ts "
+                  "WHERE maptype = %s AND subtype = %s")
+    query_open = ("SELECT prefix_id, asn FROM t_origin_intervals "
+                  "WHERE maptype = %s AND subtype = %s AND ts1 IS NULL")
+    cur.execute(query_last, [maptype, subtype])
+    row = cur.fetchone()
+    if row is None:
+        return [None, set()]
+    ts_last = row[0].strftime('%Y-%m-%d %H:%M:%S')
+    cur.execute(query_open, [maptype, subtype])
+    return [ts_last, set((pid, asn) for pid, asn in cur)]
+
+def outputIntervals(data,dbconnstr):
+    # extend, open and close origin intervals of the collector, datasets
+    # have to arrive in order of their timestamp
+    print_info(dbconnstr)
+    try:
+        con = getConnection(dbconnstr)
+    except Exception, e:
+        print_error("%s failed with: %s" % (mp.current_process().name, e.message))
+        print_error("outputIntervals: connecting to database")
+        sys.exit(1)
+
+    cur = con.cursor()
+    create_closed = ("CREATE TEMP TABLE IF NOT EXISTS tmp_intervals "
+                     "(prefix_id INT, asn INT)")
+    update_closed = ("UPDATE t_origin_intervals AS i SET ts1 = %s "
+                     "FROM tmp_intervals AS t "
+                     "WHERE i.maptype = %s AND i.subtype = %s "
+                     "AND i.ts1 IS NULL AND i.prefix_id = t.prefix_id "
+                     "AND i.asn = t.asn")
+    update_last = ("INSERT INTO t_origin_intervals_ts VALUES (%s,%s,%s) "
+                   "ON CONFLICT (maptype, subtype) "
+                   "DO UPDATE SET ts_last = EXCLUDED.ts_last")
+    copy_opened = ("COPY t_origin_intervals "
+                   "(maptype, subtype, prefix_id, asn, ts0) FROM STDIN")
+
+    maptype = data['maptype']
+    subtype = data['subtype']
+    ts_str = datetime.fromtimestamp(
+                data['timestamp']).strftime('%Y-%m-%d %H:%M:%S')
+    key = (maptype, subtype)
+    if key not in open_intervals:
         try:
-            cur.copy_from(f_pfx, 't_prefixes', columns=('prefix'))
+            open_intervals[key] = loadOpenIntervals(cur, maptype, subtype)
         except Exception, e:
-            print_error("COPY TO t_prefixes failed with: %s" % (e.message))
+            print_error("QUERY t_origin_intervals failed with: %s" %
+                        (e.message))
             con.rollback()
-    # update prefix dict
+            return
+    ts_last, current = open_intervals[key]
+    if (ts_last is not None) and (ts_str <= ts_last):
+        print_warn("skip %s %s %s, intervals already extended to %s" %
+                   (maptype, subtype, ts_str, ts_last))
+        return
+    origins = data['origins']
+    updatePrefixIds(con, cur, origins)
+    pairs = set()
+    for prefix, asns in iterOrigins(origins):
+        pid = prefix_ids.get(prefixKey(prefix), 0)
+        if pid > 0:
+            for a in asns:
+                if a > 0:
+                    pairs.add((pid, a))
+    closed = current - pairs
+    opened = pairs - current
+    # register the dataset, close, open and move ts_last in one transaction
     try:
-        cur.execute(query_all_prefixes)
-        pfx = cur.fetchall()
-        prefix_ids = dict((pfx[i][0], pfx[i][1]) for i in range(len(pfx)))
+        getDataset(cur, ts_str, maptype, subtype)
+        if closed:
+            cur.execute(create_closed)
+            cur.execute("TRUNCATE tmp_intervals")
+            f = StringIO.StringIO(''.join("%d\t%d\n" % k for k in closed))
+            cur.copy_from(f, 'tmp_intervals')
+            cur.execute(update_closed, [ts_last, maptype, subtype])
+        if opened:
+            f = StringIO.StringIO(''.join("%s\t%s\t%d\t%d\t%s\n" %
+                                          (maptype, subtype, k[0], k[1], ts_str)
+                                          for k in opened))
+            cur.copy_expert(sql=copy_opened, file=f)
+        cur.execute(update_last, [maptype, subtype, ts_str])
+        con.commit()
     except Exception, e:
-        print_error("QUERY t_prefixes (2) failed with: %s" % (e.message))
+        print_error("output of origin intervals failed with: %s" %
+                    (e.message))
         con.rollback()
-    t_file = "/tmp/" + t_origins_ym + ".copy"
-    # insert all origins into database
-    f = open(t_file, "wb")
-    for p in origins:
-        pid = 0
-        ptmp = p['prefix']
-        if ptmp.endswith('/32'):
-            ptmp = p['prefix'][:-3]
-        if ptmp in prefix_ids:
-            pid = prefix_ids[ptmp]
-        else:
-            try:
-                cur.execute(query_prefix, [p['prefix']])
-                pid = cur.fetchone()[0]
-            except:
-                con.rollback()
-                cur.execute(insert_prefix, [p['prefix']])
-                con.commit()
-                pid = cur.fetchone()[0]
-            prefix_ids[p['prefix']] = pid
-        if pid > 0:
-            for a in p['origins']:
-                if (int(a)>0) and (int(did)>0):
-                    f.write("%s\t%s\t%s\n" % (did,pid,a))
-    f.close()
+        return
+    print_info("intervals %s %s: %d opened, %d closed, %d open" %
+               (maptype, subtype, len(opened), len(closed), len(pairs)))
+    open_intervals[key] = [ts_str, pairs]
+
+def finalizeStaging(dbconnstr):
+    # add keys to staging tables and swap them in as partitions. If the
+    # partition of the month exists already, the staging table becomes a
+    # child of it (t_origins_YYYY_MM_N), so the rows do not have to be
+    # copied through its indexes again; queries on the month still see them
+    query_staging = ("SELECT tablename FROM pg_tables "
+                     "WHERE tablename LIKE 't_origins_%_staging' "
+                     "ORDER BY tablename")
+    query_exists = "SELECT to_regclass(%s)"
+    add_keys = ("ALTER TABLE %s "
+                "ADD PRIMARY KEY (dataset_id, prefix_id, asn), "
+                "ADD FOREIGN KEY (dataset_id) REFERENCES t_datasets (id), "
+                "ADD FOREIGN KEY (prefix_id) REFERENCES t_prefixes (id)")
     try:
-        copy_from_stdin = "COPY %s FROM STDIN"
-        with open(t_file, "rb") as f:
-            cur.copy_expert(sql=copy_from_stdin % t_origins_ym, file=f)
+        import psycopg2
+        con = psycopg2.connect(dbconnstr)
+    except Exception, e:
+        print_error("finalizeStaging: connecting to database")
+        print_error("failed with: %s" % ( e.message))
+        return
+    cur = con.cursor()
+    cur.execute(query_staging)
+    tables = [row[0] for row in cur.fetchall()]
+    for t_staging in tables:
+        t_origins_ym = t_staging[:-len("_staging")]
+        try:
+            cur.execute(query_exists, [t_origins_ym])
+            if cur.fetchone()[0] is None:
+                t_final, t_parent = t_origins_ym, "t_origins"
+            else:
+                t_parent = t_origins_ym
+                n = 0
+                while True:
+                    n += 1
+                    t_final = "%s_%d" % (t_origins_ym, n)
+                    cur.execute(query_exists, [t_final])
+                    if cur.fetchone()[0] is None:
+                        break
+            cur.execute(add_keys % t_staging)
+            cur.execute("ALTER TABLE %s RENAME TO %s" % (t_staging, t_final))
+            cur.execute("ALTER TABLE %s INHERIT %s" % (t_final, t_parent))
+            print_log("finalized %s as %s, child of %s" %
+                      (t_staging, t_final, t_parent))
             con.commit()
-        #cur.execute(copy_origins)
-        #con.commit()
+        except Exception, e:
+            print_error("finalize %s failed with: %s" % (t_staging, e.message))
+            con.rollback()
+    con.close()
+
+def outputSQLite(data,fname):
+    global sqlite_con
+    if sqlite_con is None:
+        sqlite_con = sqlitedb.connect(fname)
+    ts_str = datetime.fromtimestamp(
+                data['timestamp']).strftime('%Y-%m-%d %H:%M:%S')
+    try:
+        sqlitedb.store_origins(sqlite_con, ts_str, data['maptype'],
+                               data['subtype'], iterOrigins(data['origins']),
+                               replace)
     except Exception, e:
-        print_error("COPY t_origins FROM file failed with: %s" %
-                    (e.message))
-        con.rollback()
+        print_error("output to SQLite %s failed with: %s" % (fname, str(e)))
 
 def outputStdout(data):
-    print (json.dumps(data, sort_keys=True, indent=2, separators=(',', ': ')))
+    print (json.dumps(originsJSON(data), sort_keys=True, indent=2, separators=(',', ': ')))
 
 def outputThread(outq, opts):
     print_log("start outputThread")
@@ -275,10 +634,13 @@ def outputThread(outq, opts):
         if (odata == 'DONE'):
             break
         try:
-            output(odata, opts)
+            fin, data = odata
+            output(data, opts)
+            markDone(fin)
         except Exception, e:
             print_error("%s failed with: %s" %
                         (mp.current_process().name, e.message))
+    closeArchives()
     return True
 
 def main():
@@ -298,6 +660,30 @@ def main():
     parser.add_argument('-n', '--numthreads',
                         help='Set number of threads.',
                         type=int, default=None)
+    parser.add_argument('--writers',
+                        help='Number of output processes in threaded mode, '
+                             'each one writes its own monthly partitions.',
+                        type=int, default=1)
+    parser.add_argument('--copy-binary',
+                        help='Use binary COPY format for Postgres output.',
+                        action='store_true', default=False)
+    parser.add_argument('--staging',
+                        help='Load origins into unindexed staging tables, '
+                             'add keys and swap them in at the end, as '
+                             'child tables of months already loaded.',
+                        action='store_true', default=False)
+    parser.add_argument('--replace',
+                        help='Re-ingest datasets already in the database '
+                             'and replace their origins.',
+                        action='store_true', default=False)
+    parser.add_argument('--intervals',
+                        help='Store origins as intervals per collector '
+                             '(Postgres only), files are processed in order.',
+                        action='store_true', default=False)
+    parser.add_argument('-d', '--direct',
+                        help='Threaded workers write output themselves, '
+                             'JSON goes to one file per worker.',
+                        action='store_true', default=False)
     imode = parser.add_mutually_exclusive_group(required=True)
     imode.add_argument('-s', '--single',
                         help='Process a single file.')
@@ -313,6 +699,30 @@ def main():
     omode.add_argument('-p', '--postgres',
                         help='Write data to PostgresqlDB.',
                         default=False)
+    omode.add_argument('--sqlite',
+                        help='Write data to SQLite database file.',
+                        default=False)
+    parser.add_argument('--catalog',
+                        help='Archive catalog file, refreshed incrementally.',
+                        default=None)
+    parser.add_argument('--begin',
+                        help='Only files from this date (inclusive), format: yyyy-mm-dd',
+                        type=valid_date, default=None)
+    parser.add_argument('--until',
+                        help='Only files before this date (exclusive), format: yyyy-mm-dd',
+                        type=valid_date, default=None)
+    parser.add_argument('--collector',
+                        help='Only files of this collector (subtype), repeatable.',
+                        action='append', default=None)
+    parser.add_argument('--manifest',
+                        help='Resume manifest, skip work already recorded there.',
+                        default=None)
+    parser.add_argument('--prefetch',
+                        help='Number of files to parse ahead in serial mode (0: off).',
+                        type=int, default=1)
+    parser.add_argument('--prefetch-reserve',
+                        help='Stop parsing ahead if less memory [MB] is available.',
+                        type=int, default=1024)
     args = vars(parser.parse_args())
 
     global verbose
@@ -324,6 +734,18 @@ def main():
     global logging
     logging   = args['logging']
 
+    global copy_binary
+    copy_binary = args['copy_binary']
+
+    global staging
+    staging = args['staging']
+
+    global replace
+    replace = args['replace']
+
+    global resume
+    resume    = Manifest(args['manifest'])
+
     recursive = args['recursive']
     threads   = args['threads']
     workers   = args['numthreads']
@@ -338,13 +760,28 @@ def main():
     if args['postgres']:
         oopts['output'] = 'postgres'
         oopts['params'] = args['postgres']
+        if args['intervals']:
+            oopts['output'] = 'intervals'
+    elif args['intervals']:
+        print_error("intervals need Postgres output!")
+        exit(1)
     if args['json']:
         oopts['output'] = 'json'
         oopts['params'] = args['json']
+    if args['sqlite']:
+        oopts['output'] = 'sqlite'
+        oopts['params'] = args['sqlite']
 
     start_time = datetime.now()
 
     print_log("START: " + start_time.strftime('%Y-%m-%d %H:%M:%S'))
+    if (oopts['output'] == 'postgres') and not replace:
+        # skip datasets already in the database before parsing them
+        loadExistingData(oopts['params'])
+    elif (oopts['output'] == 'sqlite') and not replace:
+        existing_data.update(
+            sqlitedb.existing_datasets(sqlitedb.connect(oopts['params'])))
+        print_log("read %d data sets." % (len(existing_data)))
     if bulk:
         print_log('mode: bulk')
 
@@ -353,23 +790,48 @@ def main():
             exit(1)
 
         all_files = []
-        if recursive:
-            for dirpath, dirnames, filenames in os.walk(bulk):
-                for filename in [f for f in filenames
-                        if (re_file_rv.match(f) or re_file_rr.match(f))]:
-                    all_files.append(os.path.join(dirpath, filename))
-        else:
-            for filename in [f for f in os.listdir(bulk)
-                        if (re_file_rv.match(f) or re_file_rr.match(f))]:
-                all_files.append(os.path.join(bulk, filename))
-
-        all_files.sort()
+        for e in find_files(bulk, recursive, args['catalog'],
+                            args['begin'], args['until'],
+                            args['collector']):
+            file_info[e[0]] = e[1:4]
+            all_files.append(e[0])
         print_log("matching files: %d" % (len(all_files)))
+        # skip finished files before anything gets decompressed
+        all_files = [f for f in all_files if not isDone(f)]
+        print_log("pending files: %d" % (len(all_files)))
+        if oopts['output'] == 'intervals':
+            # intervals are extended dataset by dataset, keep them in order
+            all_files.sort(key=lambda f: parseFilename(f)[::-1])
+            if threads:
+                print_warn("intervals are written in order, no threads.")
+                threads = False
+
+        direct = args['direct']
+        if direct and not oopts['output']:
+            print_warn("direct mode needs JSON, Postgres or SQLite output.")
+            direct = False
+        if threads and direct:
+            # queue carries file names only, workers write results directly
+            input_queue = mp.Queue()
+            processes = []
+            for f in all_files:
+                input_queue.put(f)
+            for w in xrange(workers):
+                wopts = dict(oopts)
+                if oopts['output'] == 'json':
+                    wopts['params'] = shardName(oopts['params'], w)
+                p = mp.Process(target=workerThread,
+                            args=(input_queue,None,wopts))
+                p.start()
+                processes.append(p)
+                input_queue.put('DONE')
 
-        if threads:
-            mgr = mp.Manager()
-            input_queue = mgr.Queue()
-            output_queue = mgr.Queue()
+            for p in processes:
+                p.join()
+        elif threads:
+            input_queue = mp.Queue()
+            writers = max(args['writers'], 1)
+            output_queues = [mp.Queue() for w in xrange(writers)]
             processes = []
             # fill input queue
             for f in all_files:
@@ -377,27 +839,41 @@ def main():
             # start workers to calc stats
             for w in xrange(workers):
                 p = mp.Process(target=workerThread,
-                            args=(input_queue,output_queue))
+                            args=(input_queue,output_queues))
                 p.start()
                 processes.append(p)
                 input_queue.put('DONE')
-            # start output process to
-            output_p = mp.Process(target=outputThread,
-                               args=(output_queue,oopts))
-            output_p.start()
+            # start output processes, one queue each
+            output_ps = []
+            for w in xrange(writers):
+                wopts = dict(oopts)
+                if (oopts['output'] == 'json') and (writers > 1):
+                    wopts['params'] = shardName(oopts['params'], w)
+                output_p = mp.Process(target=outputThread,
+                                   args=(output_queues[w],wopts))
+                output_p.start()
+                output_ps.append(output_p)
 
             for p in processes:
                 p.join()
 
-            output_queue.put('DONE')
-            output_p.join()
+            for w in xrange(writers):
+                output_queues[w].put('DONE')
+            for output_p in output_ps:
+                output_p.join()
         else:
-            for f in all_files:
-                odata = worker(f)
+            # parse next files while the current one is written
+            for f, odata in prefetch(worker, all_files,
+                                     args['prefetch'],
+                                     args['prefetch_reserve']*1024*1024):
                 output(odata, oopts)
+                markDone(f)
     elif single:
         print_log("mode: single")
         if os.path.isfile(single):
+            if isDone(single):
+                print_log("already done (%s)!" % (single))
+                exit(0)
             odata = worker(single)
             output(odata, oopts)
         else:
@@ -405,6 +881,11 @@ def main():
     else:
         print_error("Missing parameter: choose bulk or single mode!")
         exit(1)
+    closeArchives()
+
+    if staging and (oopts['output'] == 'postgres'):
+        print_log("finalize staging tables")
+        finalizeStaging(oopts['params'])
 
     end_time = datetime.now()
     print_log("FINISH: " + end_time.strftime('%Y-%m-%d %H:%M:%S'))
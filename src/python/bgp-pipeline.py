@@ -0,0 +1,395 @@
+#!/usr/bin/python
+
+from __future__ import print_function
+
+import argparse
+import gzip
+import imp
+import os
+import sys
+
+from bz2 import BZ2File
+from collections import OrderedDict
+from datetime import datetime
+
+# own imports
+import mrtx
+import sqlitedb
+from catalog import find_files
+from manifest import Manifest
+from prefetch import prefetch
+
+verbose = False
+warning = False
+logging = False
+
+resume = Manifest()
+
+# (ts, maptype, subtype) of files found through the catalog
+file_info = dict()
+
+# name -> analyzer class, see register()
+analyzers = OrderedDict()
+
+# bgp-* scripts loaded as modules, see loadTool()
+tools = dict()
+
+'''
+Single pass over RIB dumps for several analyses.
+
+Every file is decompressed and parsed once, the parsed data is handed to
+all analyzers that still need the file:
+
+    stats       STATS and DIFFS lines of bgp-stats
+    ribstats    prefix and per ASN stats of bgp-rib-stats
+    ribdiffs    diffs of consecutive dumps of bgp-rib-diffs
+    origins     origins export of bgp-origins
+
+Each analyzer writes to its own sink, given as -a NAME=SINK. For the CSV
+analyzers the sink is a file (appended) or '-' for STDOUT, for origins
+it is 'postgres:DSN', 'sqlite:FILE', a JSON archive file or '-'. Finished
+work is recorded in the resume manifest with the same kinds as the single
+tools, so both can be mixed.
+
+Custom analyzers are loaded with --plugin MODULE:CLASS, the class needs a
+name and the methods of Analyzer below.
+
+With --prefetch N the next N files are parsed by worker processes while
+the analyzers work on the current one. The parsed data is pickled back to
+this process, which costs part of the parse time and holds N+1 snapshots
+in memory; --prefetch 0 parses in-process without that round trip, e.g.
+for a single analyzer that is faster than the parser anyway.
+'''
+
+def print_log(*objs):
+    if logging or verbose:
+        print("[LOGS] .", *objs, file=sys.stdout)
+
+def print_info(*objs):
+    if verbose:
+        print("[INFO] ..", *objs, file=sys.stdout)
+
+def print_warn(*objs):
+    if warning or verbose:
+        print("[WARN] ", *objs, file=sys.stderr)
+
+def print_error(*objs):
+    print("[ERROR] ", *objs, file=sys.stderr)
+
+def valid_date(s):
+    try:
+        return datetime.strptime(s, "%Y-%m-%d")
+    except ValueError:
+        msg = "Not a valid date: '{0}'.".format(s)
+        raise argparse.ArgumentTypeError(msg)
+
+def loadTool(script):
+    # import one of the bgp-* scripts as module, sharing our settings
+    if script not in tools:
+        path = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                            script)
+        name = os.path.splitext(script)[0].replace('-', '_')
+        tool = imp.load_source(name, path)
+        tool.verbose = verbose
+        tool.warning = warning
+        tool.logging = logging
+        tool.resume = resume
+        tool.file_info = file_info
+        tools[script] = tool
+    return tools[script]
+
+def parseFile(fin):
+    print_log("call parseFile (%s)"  % (fin))
+    f = (BZ2File(fin, 'rb'), gzip.open(fin, 'rb'))[fin.lower().endswith('.gz')]
+    data = mrtx.parse_mrt_file(f, print_progress=verbose)
+    f.close()
+    return data
+
+def pendingPairs(files, kind):
+    # indices i of adjacent files (i, i+1) of one collector without diffs
+    pairs = set()
+    for i in xrange(len(files)-1):
+        ts0, mt0, st0 = file_info[files[i]]
+        ts1, mt1, st1 = file_info[files[i+1]]
+        if (mt0 != mt1) or (st0 != st1):
+            continue
+        if not resume.done(mt0, st0, ts0, kind, files[i], files[i+1]):
+            pairs.add(i)
+    return pairs
+
+class Sink(object):
+    # output lines to a file, appended, or to STDOUT for '-'
+    def __init__(self, target, header=None):
+        self.f = None
+        if target and (target != '-'):
+            new = not (os.path.isfile(target) and os.path.getsize(target))
+            self.f = open(target, "a")
+            if new and header:
+                self.write(header)
+
+    def write(self, line):
+        if self.f:
+            self.f.write(line+'\n')
+            self.f.flush()
+        else:
+            print(line)
+            sys.stdout.flush()
+
+    def close(self):
+        if self.f:
+            self.f.close()
+
+class Analyzer(object):
+    # base of all analyzers, name is the NAME of -a NAME=SINK
+    name = None
+
+    def __init__(self, target):
+        self.target = target
+
+    def begin(self, files):
+        # all input files in order, returns those this analyzer needs
+        return files
+
+    def feed(self, fin, ts, mt, st, data):
+        # parsed MRT data (prefix -> origins) of each needed file, in order
+        pass
+
+    def close(self):
+        pass
+
+def register(cls):
+    analyzers[cls.name] = cls
+    return cls
+
+class StatsAnalyzer(Analyzer):
+    # STATS and DIFFS of bgp-stats
+    name = 'stats'
+
+    def begin(self, files):
+        self.tool = loadTool('bgp-stats.py')
+        self.sink = Sink(self.target)
+        self.files = files
+        self.index = dict((files[i], i) for i in xrange(len(files)))
+        self.pairs = pendingPairs(files, 'diffs')
+        self.prev = None
+        need = list()
+        for i in xrange(len(files)):
+            ts, mt, st = file_info[files[i]]
+            if (not resume.done(mt, st, ts, 'stats', files[i])) or \
+                    (i in self.pairs) or ((i-1) in self.pairs):
+                need.append(files[i])
+        return need
+
+    def feed(self, fin, ts, mt, st, data):
+        i = self.index[fin]
+        pt = self.tool.buildPtree(data)
+        if not resume.done(mt, st, ts, 'stats', fin):
+            pl, pi, pb, pm = self.tool.getStats(pt)
+            self.sink.write(self.tool.statsLine(ts, mt, st, pl, pi, pb, pm))
+            resume.mark(mt, st, ts, 'stats', fin)
+        # only diff adjacent files, skipped ones leave gaps
+        if self.prev and (self.prev[0] == i-1) and ((i-1) in self.pairs):
+            fin0 = self.files[i-1]
+            ts0 = file_info[fin0][0]
+            diffs = self.tool.getDiffs(self.prev[1], pt)
+            self.sink.write(self.tool.diffsLine(ts0, ts, mt, st, diffs))
+            resume.mark(mt, st, ts0, 'diffs', fin0, fin)
+        # keep the tree only if the next pair is still to do
+        self.prev = (i, pt) if (i in self.pairs) else None
+
+    def close(self):
+        self.prev = None
+        self.sink.close()
+
+class RibStatsAnalyzer(Analyzer):
+    # prefix and per ASN stats of bgp-rib-stats
+    name = 'ribstats'
+
+    def begin(self, files):
+        self.tool = loadTool('bgp-rib-stats.py')
+        self.sink = Sink(self.target, ';'.join(self.tool.output_header))
+        return [f for f in files if not self.tool.isDone(f)]
+
+    def feed(self, fin, ts, mt, st, data):
+        dout = [ts, mt, st]
+        dout.extend(self.tool.getStats(self.tool.buildPtree(data)))
+        self.sink.write(';'.join(str(x) for x in dout))
+        resume.mark(mt, st, ts, 'ribstats', fin)
+
+    def close(self):
+        self.sink.close()
+
+class RibDiffsAnalyzer(Analyzer):
+    # diffs of consecutive dumps of bgp-rib-diffs
+    name = 'ribdiffs'
+
+    def begin(self, files):
+        self.tool = loadTool('bgp-rib-diffs.py')
+        self.sink = Sink(self.target)
+        self.files = files
+        self.index = dict((files[i], i) for i in xrange(len(files)))
+        self.pairs = pendingPairs(files, 'ribdiffs')
+        self.prev = None
+        return [files[i] for i in xrange(len(files))
+                if (i in self.pairs) or ((i-1) in self.pairs)]
+
+    def feed(self, fin, ts, mt, st, data):
+        i = self.index[fin]
+        pt = self.tool.buildPtree(data)
+        if self.prev and (self.prev[0] == i-1) and ((i-1) in self.pairs):
+            fin0 = self.files[i-1]
+            ts0 = file_info[fin0][0]
+            diffs = self.tool.getDiffs(self.prev[1], pt)
+            output = str(ts0)+';'+str(ts)+';'+mt+';'+st+';'
+            output += ';'.join(str(x) for x in diffs)
+            self.sink.write(output)
+            resume.mark(mt, st, ts0, 'ribdiffs', fin0, fin)
+        # keep the tree only if the next pair is still to do
+        self.prev = (i, pt) if (i in self.pairs) else None
+
+    def close(self):
+        self.prev = None
+        self.sink.close()
+
+class OriginsAnalyzer(Analyzer):
+    # origins export of bgp-origins
+    name = 'origins'
+
+    def begin(self, files):
+        self.tool = loadTool('bgp-origins.py')
+        self.oopts = dict()
+        self.oopts['output'] = False
+        target = self.target
+        if target and target.startswith('postgres:'):
+            self.oopts['output'] = 'postgres'
+            self.oopts['params'] = target[len('postgres:'):]
+            self.tool.loadExistingData(self.oopts['params'])
+        elif target and target.startswith('sqlite:'):
+            self.oopts['output'] = 'sqlite'
+            self.oopts['params'] = target[len('sqlite:'):]
+            self.tool.existing_data.update(sqlitedb.existing_datasets(
+                sqlitedb.connect(self.oopts['params'])))
+        elif target and (target != '-'):
+            self.oopts['output'] = 'json'
+            self.oopts['params'] = target
+        return [f for f in files if not self.tool.isDone(f)]
+
+    def feed(self, fin, ts, mt, st, data):
+        odata = dict()
+        odata['timestamp'] = ts
+        odata['maptype'] = mt
+        odata['subtype'] = st
+        odata['origins'] = self.tool.buildOrigins(data)
+        self.tool.output(odata, self.oopts)
+        self.tool.markDone(fin)
+
+    def close(self):
+        self.tool.closeArchives()
+
+register(StatsAnalyzer)
+register(RibStatsAnalyzer)
+register(RibDiffsAnalyzer)
+register(OriginsAnalyzer)
+
+def loadPlugin(spec):
+    # MODULE:CLASS, the module has to be on the python path
+    mname, sep, cname = spec.partition(':')
+    if not (mname and cname):
+        raise ValueError("plugin must be given as MODULE:CLASS")
+    cls = getattr(__import__(mname, fromlist=[cname]), cname)
+    if not getattr(cls, 'name', None):
+        raise ValueError("analyzer %s has no name" % (spec))
+    return register(cls)
+
+def main():
+    parser = argparse.ArgumentParser(
+        epilog='analyzers: stats, ribstats, ribdiffs, origins and those '
+               'of --plugin. Sinks: file or - (STDOUT), for origins '
+               'also postgres:DSN or sqlite:FILE.')
+    parser.add_argument('-l', '--logging',      help='Ouptut logging.', action='store_true')
+    parser.add_argument('-w', '--warning',      help='Output warnings.', action='store_true')
+    parser.add_argument('-v', '--verbose',      help='Verbose output with debug info, logging, and warnings.', action='store_true')
+    parser.add_argument('-a', '--analyzer',     help='Run analyzer NAME, writing to SINK (default: STDOUT), format NAME[=SINK], repeatable.', action='append', required=True)
+    parser.add_argument('--plugin',             help='Register custom analyzer, format MODULE:CLASS, repeatable.', action='append', default=None)
+    parser.add_argument('-r', '--recursive',    help='Search directories recursivly.', action='store_true')
+    parser.add_argument('--catalog',            help='Archive catalog file, refreshed incrementally.', default=None)
+    parser.add_argument('--begin',              help='Only files from this date (inclusive), format: yyyy-mm-dd', type=valid_date, default=None)
+    parser.add_argument('--until',              help='Only files before this date (exclusive), format: yyyy-mm-dd', type=valid_date, default=None)
+    parser.add_argument('--collector',          help='Only files of this collector (subtype), repeatable.', action='append', default=None)
+    parser.add_argument('--manifest',           help='Resume manifest, skip work already recorded there.', default=None)
+    parser.add_argument('--prefetch',           help='Number of files to parse ahead (0: off).', type=int, default=1)
+    parser.add_argument('--prefetch-reserve',   help='Stop parsing ahead if less memory [MB] is available.', type=int, default=1024)
+    parser.add_argument('path',                 help='Path to data.')
+
+    args = vars(parser.parse_args())
+
+    global verbose
+    verbose   = args['verbose']
+
+    global warning
+    warning   = args['warning']
+
+    global logging
+    logging   = args['logging']
+
+    global resume
+    resume    = Manifest(args['manifest'])
+
+    for spec in (args['plugin'] or []):
+        try:
+            loadPlugin(spec)
+        except Exception, e:
+            print_error("Failed to load plugin %s: %s" % (spec, e))
+            exit(1)
+
+    active = list()
+    for spec in args['analyzer']:
+        name, sep, target = spec.partition('=')
+        if name not in analyzers:
+            print_error("Unknown analyzer: %s" % (name))
+            exit(1)
+        active.append(analyzers[name](target or None))
+
+    path = args['path']
+
+    start_time = datetime.now()
+
+    print_log("START: " + start_time.strftime('%Y-%m-%d %H:%M:%S'))
+
+    if not (os.path.isdir(path)):
+        print_error("Invalid path for processing!")
+        exit(1)
+
+    all_files = []
+    for e in find_files(path, args['recursive'], args['catalog'], args['begin'], args['until'], args['collector']):
+        file_info[e[0]] = e[1:4]
+        all_files.append(e[0])
+    print_log("matching files: %d" % (len(all_files)))
+
+    needs = [set(a.begin(all_files)) for a in active]
+    todo_files = [f for f in all_files if any(f in n for n in needs)]
+    print_log("pending files: %d" % (len(todo_files)))
+
+    # one decompression and parse per file, next ones parsed ahead
+    for fin, data in prefetch(parseFile, todo_files, args['prefetch'],
+                              args['prefetch_reserve']*1024*1024):
+        ts, mt, st = file_info[fin]
+        for a, need in zip(active, needs):
+            if fin not in need:
+                continue
+            try:
+                a.feed(fin, ts, mt, st, data)
+            except Exception, e:
+                print_error("%s failed on %s with: %s" % (a.name, fin, e))
+        data = None
+
+    for a in active:
+        a.close()
+
+    end_time = datetime.now()
+    print_log("FINISH: " + end_time.strftime('%Y-%m-%d %H:%M:%S'))
+    done_time = end_time - start_time
+    print_log("  processing time [s]: " + str(done_time.total_seconds()))
+
+if __name__ == "__main__":
+    main()
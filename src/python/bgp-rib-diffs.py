@@ -5,41 +5,34 @@ from __future__ import print_function
 import argparse
 import gzip
 import os
-import radix
 import re
 import sys
 
 from bz2 import BZ2File
 from datetime import datetime, timedelta
 from multiprocessing import Process, Queue, cpu_count
-from netaddr import IPSet, IPNetwork
 
 # own imports
 import mrtx
+import reserved
+from catalog import find_files
+from manifest import Manifest
 
 verbose = False
 warning = False
 logging = False
 
+resume = Manifest()
+
+# (ts, maptype, subtype) of files found through the catalog
+file_info = dict()
+
 re_file_rv = re.compile('rib.(\d+).(\d\d\d\d).bz2')
 re_file_rr = re.compile('bview.(\d+).(\d\d\d\d).gz')
 
 re_path_rv = re.compile('.*/([a-z0-9\.-]+)/bgpdata/\d\d\d\d.\d\d/RIBS.*')
 re_path_rr = re.compile('.*/(rrc\d\d)/\d\d\d\d.\d\d.*')
 
-reserved_ipv4 = IPSet (['0.0.0.0/8',                                        # host on this network (RFC1122)
-                        '10.0.0.0/8','172.16.0.0/12','192.168.0.0/16',      # private address space (RFC1918)
-                        '100.64.0.0/10',                                    # shared address space (RFC6598)
-                        '127.0.0.0/8',                                      # loopback (RFC1122)
-                        '169.254.0.0/16',                                   # linklocal (RFC3927)
-                        '192.0.0.0/24',                                     # special purpose (RFC6890)
-                        '192.0.0.0/29',                                     # DS-lite (RFC6333)
-                        '192.0.2.0/24','198.51.100.0/24','203.0.113.0/24',  # test net 1-3 (RFC5737)
-                        '224.0.0.0/4',                                      # multicast address space
-                        '240.0.0.0/4',                                      # future use (RFC1122)
-                        '255.255.255.255/32'                                # limited broadcast
-                    ]) 
-
 '''
 OUTPUT FORMAT:
 
@@ -67,11 +60,23 @@ def print_warn(*objs):
 def print_error(*objs):
     print("[ERROR] ", *objs, file=sys.stderr)
 
+def valid_date(s):
+    try:
+        return datetime.strptime(s, "%Y-%m-%d")
+    except ValueError:
+        msg = "Not a valid date: '{0}'.".format(s)
+        raise argparse.ArgumentTypeError(msg)
+
 def loadPtree(fin):
     print_log("call loadPtree (%s)"  % (fin))
     f = (BZ2File(fin, 'rb'), gzip.open(fin, 'rb'))[fin.lower().endswith('.gz')]
     data = mrtx.parse_mrt_file(f, print_progress=verbose)
     f.close()
+    return buildPtree(data)
+
+def buildPtree(data):
+    # prefix tree of already parsed MRT data, see also bgp-pipeline
+    import radix
     ptree = radix.Radix()
     for prefix, origins in data.items():
         pnode = ptree.add(prefix)
@@ -84,6 +89,8 @@ def loadPtree(fin):
 
 def parseFilename(fin):
     print_log("call parseFilename (%s)" % (fin))
+    if fin in file_info:
+        return file_info[fin]
 
     maptype = 'none'
     subtype = 'none'
@@ -121,6 +128,8 @@ def parseFilename(fin):
 #add num_pfx_new, num_pfx_del, num_asn_new, num_asn_del
 def getDiffs (pt0, pt1):
     print_log("call getDiffs")
+    from netaddr import IPSet, IPNetwork
+    reserved_ipv4 = reserved.ipv4()
     ips_agg = IPSet()
     ips_deagg = IPSet()
     pt0IPs = IPSet(pt0.prefixes()) - reserved_ipv4
@@ -158,11 +167,15 @@ def singleWorker(wd, fin):
 
     ts0, mt0, st0 = parseFilename(fin[0])
     ts1, mt1, st1 = parseFilename(fin[1])
+    if resume.done(mt0, st0, ts0, 'ribdiffs', fin[0], fin[1]):
+        print_info("data set exists, skipping ...")
+        return
     if (mt0==mt1) and (st0==st1):
         pt0 = loadPtree(fin[0])
         pt1 = loadPtree(fin[1])
         diffs = getDiffs(pt0, pt1)
-    outputDiffs(wd,ts0,ts1,mt0,st0,diffs)
+        outputDiffs(wd,ts0,ts1,mt0,st0,diffs)
+        resume.mark(mt0, st0, ts0, 'ribdiffs', fin[0], fin[1])
 
 def diffsThread(inq,outq):
     print_log("start diffsThread")
@@ -171,11 +184,14 @@ def diffsThread(inq,outq):
         try:
             ts0, mt0, st0 = parseFilename(fin[0])
             ts1, mt1, st1 = parseFilename(fin[1])
+            if resume.done(mt0, st0, ts0, 'ribdiffs', fin[0], fin[1]):
+                print_info("data set exists, skipping ...")
+                continue
             if (mt0==mt1) and (st0==st1):
                 pt0 = loadPtree(fin[0])
                 pt1 = loadPtree(fin[1])
                 diffs = getDiffs(pt0, pt1)
-                outq.put([ts0,ts1,mt0,st0,diffs])
+                outq.put([ts0,ts1,mt0,st0,diffs,fin])
         except Exception, e:
             print_error("%s failed on %s with: %s" % (current_process().name, url, e.message))
     return True
@@ -187,6 +203,8 @@ def outputThread(outq, outf):
             break
         try:
             outputDiffs(outf,odata[0],odata[1],odata[2],odata[3],odata[4])
+            resume.mark(odata[2], odata[3], odata[0], 'ribdiffs',
+                        odata[5][0], odata[5][1])
         except Exception, e:
             print_error("%s failed on %s with: %s" % (current_process().name, url, e.message))
     return True
@@ -210,6 +228,11 @@ def main():
     parser.add_argument('-n', '--numthreads',   help='Set number of threads.', type=int, default=None)
     parser.add_argument('-r', '--recursive',    help='Search directories recursivly if in bulk mode.', action='store_true')
     parser.add_argument('-f', '--file',         help='Write results to file.', default=None)
+    parser.add_argument('--catalog',            help='Archive catalog file, refreshed incrementally.', default=None)
+    parser.add_argument('--begin',              help='Only files from this date (inclusive), format: yyyy-mm-dd', type=valid_date, default=None)
+    parser.add_argument('--until',              help='Only files before this date (exclusive), format: yyyy-mm-dd', type=valid_date, default=None)
+    parser.add_argument('--collector',          help='Only files of this collector (subtype), repeatable.', action='append', default=None)
+    parser.add_argument('--manifest',           help='Resume manifest, skip work already recorded there.', default=None)
     parser.add_argument('path',                 help='Path to data.')
 
     args = vars(parser.parse_args())
@@ -223,6 +246,9 @@ def main():
     global logging
     logging   = args['logging']
 
+    global resume
+    resume    = Manifest(args['manifest'])
+
     writedata = args['file']
     recursive = args['recursive']
     threads   = args['threads']
@@ -241,15 +267,9 @@ def main():
         exit(1)
 
     all_files = []
-    if recursive:
-        for dirpath, dirnames, filenames in os.walk(path):
-            for filename in [f for f in filenames if (re_file_rv.match(f) or re_file_rr.match(f))]:
-                all_files.append(os.path.join(dirpath, filename))
-    else:
-        for filename in [f for f in os.listdir(path) if (re_file_rv.match(f) or re_file_rr.match(f))]:
-            all_files.append(os.path.join(path, filename))
-
-    all_files.sort()
+    for e in find_files(path, recursive, args['catalog'], args['begin'], args['until'], args['collector']):
+        file_info[e[0]] = e[1:4]
+        all_files.append(e[0])
     print_log("matching files: %d" % (len(all_files)))
 
     if threads:
@@ -259,7 +279,8 @@ def main():
         # fill input queue
         for i in range(len(all_files)-1):
             input_queue.put([all_files[i],all_files[i+1]])
-        # start workers to calc stats
+        # start workers to calc stats, they inherit the reserved tables
+        reserved.warm()
         for w in xrange(workers):
             p = Process(target=diffsThread, args=(input_queue,output_queue))
             p.start()
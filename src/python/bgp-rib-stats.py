@@ -5,17 +5,20 @@ from __future__ import print_function
 import argparse
 import gzip
 import os
-import radix
 import re
 import sys
 
 from bz2 import BZ2File
 from datetime import datetime, timedelta
 from multiprocessing import Process, Queue, cpu_count
-from netaddr import IPSet
 
 # own imports
 import mrtx
+import reserved
+from catalog import find_files
+from governor import Governor, measure
+from manifest import Manifest
+from prefetch import prefetch
 
 verbose = False
 warning = False
@@ -27,20 +30,17 @@ re_file_rr = re.compile('bview.(\d+).(\d\d\d\d).gz')
 re_path_rv = re.compile('.*/([a-z0-9\.-]+)/bgpdata/\d\d\d\d.\d\d/RIBS.*')
 re_path_rr = re.compile('.*/(rrc\d\d)/\d\d\d\d.\d\d.*')
 
-reserved_ipv4 = IPSet (['0.0.0.0/8',                                        # host on this network (RFC1122)
-                        '10.0.0.0/8','172.16.0.0/12','192.168.0.0/16',      # private address space (RFC1918)
-                        '100.64.0.0/10',                                    # shared address space (RFC6598)
-                        '127.0.0.0/8',                                      # loopback (RFC1122)
-                        '169.254.0.0/16',                                   # linklocal (RFC3927)
-                        '192.0.0.0/24',                                     # special purpose (RFC6890)
-                        '192.0.0.0/29',                                     # DS-lite (RFC6333)
-                        '192.0.2.0/24','198.51.100.0/24','203.0.113.0/24',  # test net 1-3 (RFC5737)
-                        '224.0.0.0/4',                                      # multicast address space
-                        '240.0.0.0/4',                                      # future use (RFC1122)
-                        '255.255.255.255/32'                                # limited broadcast
-                    ]) 
-
-existing_data = list()
+existing_data = set()
+
+resume = Manifest()
+
+prefetch_depth = 1
+prefetch_reserve = 0
+
+governor = Governor()
+
+# (ts, maptype, subtype) of files found through the catalog
+file_info = dict()
 
 '''
 OUTPUT FORMAT:
@@ -69,11 +69,23 @@ def print_warn(*objs):
 def print_error(*objs):
     print("[ERROR] ", *objs, file=sys.stderr)
 
+def valid_date(s):
+    try:
+        return datetime.strptime(s, "%Y-%m-%d")
+    except ValueError:
+        msg = "Not a valid date: '{0}'.".format(s)
+        raise argparse.ArgumentTypeError(msg)
+
 def loadPtree(fin):
     print_log("call loadPtree (%s)"  % (fin))
     f = (BZ2File(fin, 'rb'), gzip.open(fin, 'rb'))[fin.lower().endswith('.gz')]
     data = mrtx.parse_mrt_file(f, print_progress=verbose)
     f.close()
+    return buildPtree(data)
+
+def buildPtree(data):
+    # prefix tree of already parsed MRT data, see also bgp-pipeline
+    import radix
     ptree = radix.Radix()
     for prefix, origins in data.items():
         pnode = ptree.add(prefix)
@@ -87,6 +99,8 @@ def loadPtree(fin):
 # add num_pfx to stats
 def getStats (ptree):
     print_log("call getStats")
+    from netaddr import IPSet
+    reserved_ipv4 = reserved.ipv4()
     pfxlen = dict()
     asn = dict()
     num_pfx_moas = 0
@@ -158,6 +172,8 @@ stats_header = ["pl01","pl02","pl03","pl04","pl05","pl06","pl07","pl08",
 
 def parseFilename(fin):
     print_log("call parseFilename (%s)" % (fin))
+    if fin in file_info:
+        return file_info[fin]
 
     maptype = 'none'
     subtype = 'none'
@@ -192,16 +208,24 @@ def parseFilename(fin):
     ts = int((datetime.strptime(dt, "%Y-%m-%d %H:%M") - datetime(1970, 1, 1)).total_seconds())
     return ts, maptype, subtype
 
-def singleWorker(wd, fin):
+def isDone(fin):
+    ts, mt, st = parseFilename(fin)
+    if (ts, mt, st) in existing_data:
+        return True
+    return resume.done(mt, st, ts, 'ribstats', fin)
+
+def singleWorker(wd, fin, pt0=None):
     print_log("call singleWorker(fin: %s)" % (fin))
 
     ts0, mt0, st0 = parseFilename(fin)
-    if ts0 not in existing_data:
-        pt0 = loadPtree(fin)
+    if not isDone(fin):
+        if pt0 is None:
+            pt0 = loadPtree(fin)
         stats = getStats(pt0)
         dout = [ts0,mt0,st0]
         dout.extend(stats)
         outputStats(wd,dout)
+        resume.mark(mt0, st0, ts0, 'ribstats', fin)
     else:
         print_info("data set exists, skipping ...")
 
@@ -211,12 +235,26 @@ def statsThread(inq, outq):
     for fin in iter(inq.get, 'DONE'):
         try:
             ts0, mt0, st0 = parseFilename(fin)
-            if ts0 not in existing_data:
-                pt0 = loadPtree(fin)
-                stats = getStats(pt0)
+            if not isDone(fin):
+                # wait until the snapshot fits into the memory budget
+                est = governor.estimate(fin)
+                governor.admit(est)
+                try:
+                    pt0, nbytes = measure(loadPtree, fin)
+                except:
+                    governor.release(est, False)
+                    raise
+                nbytes = governor.update(est, nbytes)
+                print_info("statsThread, %d bytes in flight" %
+                           governor.in_flight())
+                try:
+                    stats = getStats(pt0)
+                finally:
+                    pt0 = None
+                    governor.release(nbytes, False)
                 dout = [ts0,mt0,st0]
                 dout.extend(stats)
-                outq.put(dout)
+                outq.put((dout, fin))
             else:
                 print_info("data set exists, skipping ...")
         except Exception, e:
@@ -229,7 +267,10 @@ def outputThread(outq, outf):
         if (odata == 'DONE'):
             break
         try:
-            outputStats(outf,odata)
+            dout, fin = odata
+            outputStats(outf,dout)
+            if fin:
+                resume.mark(dout[1], dout[2], dout[0], 'ribstats', fin)
         except Exception, e:
             print_error("%s failed on %s with: %s" % (current_process().name, url, e.message))
     return True
@@ -258,6 +299,14 @@ def main():
     group.add_argument('-b', '--bulk',          help='Process a bunch of files in given directory (optional recursive).')
     parser.add_argument('-r', '--recursive',    help='Search directories recursivly if in bulk mode.', action='store_true')
     parser.add_argument('-f', '--file',         help='Write results to file.', default=None)
+    parser.add_argument('--catalog',            help='Archive catalog file, refreshed incrementally.', default=None)
+    parser.add_argument('--begin',              help='Only files from this date (inclusive), format: yyyy-mm-dd', type=valid_date, default=None)
+    parser.add_argument('--until',              help='Only files before this date (exclusive), format: yyyy-mm-dd', type=valid_date, default=None)
+    parser.add_argument('--collector',          help='Only files of this collector (subtype), repeatable.', action='append', default=None)
+    parser.add_argument('--manifest',           help='Resume manifest, skip work already recorded there.', default=None)
+    parser.add_argument('--prefetch',           help='Number of files to load ahead in serial mode (0: off).', type=int, default=1)
+    parser.add_argument('--prefetch-reserve',   help='Stop loading ahead if less memory [MB] is available.', type=int, default=1024)
+    parser.add_argument('--memory-budget',      help='Max. memory [MB] of snapshots in flight (0: unlimited).', type=int, default=0)
     args = vars(parser.parse_args())
     
     global verbose
@@ -276,14 +325,25 @@ def main():
             for line in f:
                 if line.startswith('#'):
                     continue
-                ts = line.split(';')[0].strip()
+                cols = line.split(';')
                 try:
-                    existing_data.append(int(ts))
+                    existing_data.add((int(cols[0].strip()), cols[1], cols[2]))
                 except:
                     print_error("Failure converting timestamp to integer!")
-        print_info(existing_data[0])
         print_log("read %d data sets." % (len(existing_data)))
 
+    global resume
+    resume    = Manifest(args['manifest'])
+
+    global prefetch_depth
+    prefetch_depth   = args['prefetch']
+
+    global prefetch_reserve
+    prefetch_reserve = args['prefetch_reserve'] * 1024 * 1024
+
+    global governor
+    governor  = Governor(args['memory_budget'] * 1024 * 1024)
+
     recursive = args['recursive']
     threads   = args['threads']
     workers   = args['numthreads']
@@ -304,27 +364,22 @@ def main():
             exit(1)
 
         all_files = []
-        if recursive:
-            for dirpath, dirnames, filenames in os.walk(bulk):
-                for filename in [f for f in filenames if (re_file_rv.match(f) or re_file_rr.match(f))]:
-                    all_files.append(os.path.join(dirpath, filename))
-        else:
-            for filename in [f for f in os.listdir(bulk) if (re_file_rv.match(f) or re_file_rr.match(f))]:
-                all_files.append(os.path.join(bulk, filename))
-
-        all_files.sort()
+        for e in find_files(bulk, recursive, args['catalog'], args['begin'], args['until'], args['collector']):
+            file_info[e[0]] = e[1:4]
+            all_files.append(e[0])
         print_log("matching files: %d" % (len(all_files)))
 
         if threads:
             input_queue = Queue()
             output_queue = Queue()
             if len(existing_data) == 0: # write header if no existing data
-                output_queue.put(output_header)
+                output_queue.put((output_header, None))
             processes = []
             # fill input queue
             for f in all_files:
                 input_queue.put(f)
-            # start workers to calc stats
+            # start workers to calc stats, they inherit the reserved tables
+            reserved.warm()
             for w in xrange(workers):
                 p = Process(target=statsThread, args=(input_queue,output_queue))
                 p.start()
@@ -340,14 +395,21 @@ def main():
             output_queue.put('DONE')
             output_p.join()
         else:
-            for w in all_files:
-                singleWorker(writedata, w)
+            # load next files while the current one is analysed and written
+            todo_files = [f for f in all_files if not isDone(f)]
+            for fin, pt, nbytes in prefetch(loadPtree, todo_files,
+                                            prefetch_depth, prefetch_reserve,
+                                            governor):
+                governor.take(nbytes)
+                singleWorker(writedata, fin, pt)
+                pt = None
+                governor.release(nbytes)
 
     elif single:
         print_log("mode: single")
         if os.path.isfile(single):
             ts0, mt0, st0 = parseFilename(os.path.abspath(single))
-            if ts0 not in existing_data:
+            if not isDone(os.path.abspath(single)):
                 pt0 = loadPtree(single)
                 stats = getStats(pt0)
                 dout = [ts0,mt0,st0]
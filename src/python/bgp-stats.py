@@ -5,7 +5,6 @@ from __future__ import print_function
 import argparse
 import gzip
 import os
-import radix
 import re
 import sys
 
@@ -13,10 +12,14 @@ from bz2 import BZ2File
 from collections import OrderedDict
 from datetime import datetime, timedelta
 from multiprocessing import Process, Queue
-from netaddr import IPSet, IPNetwork
 
 # own imports
 import mrtx
+import reserved
+from catalog import find_files
+from governor import Governor
+from manifest import Manifest
+from prefetch import prefetch
 
 verbose = False
 warning = False
@@ -24,10 +27,21 @@ logging = False
 
 queue_limit = 7
 
+prefetch_depth = 1
+prefetch_reserve = 0
+
+governor = Governor()
+
 ptree_limit = 3
 ptree_cache = OrderedDict()
+stats_cache = OrderedDict()
+
+stats_print = set()
+
+resume = Manifest()
 
-stats_print = []
+# (ts, maptype, subtype) of files found through the catalog
+file_info = dict()
 
 re_file_rv = re.compile('rib.(\d+).(\d\d\d\d).bz2')
 re_file_rr = re.compile('bview.(\d+).(\d\d\d\d).gz')
@@ -35,19 +49,6 @@ re_file_rr = re.compile('bview.(\d+).(\d\d\d\d).gz')
 re_path_rv = re.compile('.*/([a-z0-9\.-]+)/bgpdata/\d\d\d\d.\d\d/RIBS.*')
 re_path_rr = re.compile('.*/(rrc\d\d)/\d\d\d\d.\d\d.*')
 
-reserved_ipv4 = IPSet (['0.0.0.0/8',                                        # host on this network (RFC1122)
-                        '10.0.0.0/8','172.16.0.0/12','192.168.0.0/16',      # private address space (RFC1918)
-                        '100.64.0.0/10',                                    # shared address space (RFC6598)
-                        '127.0.0.0/8',                                      # loopback (RFC1122)
-                        '169.254.0.0/16',                                   # linklocal (RFC3927)
-                        '192.0.0.0/24',                                     # special purpose (RFC6890)
-                        '192.0.0.0/29',                                     # DS-lite (RFC6333)
-                        '192.0.2.0/24','198.51.100.0/24','203.0.113.0/24',  # test net 1-3 (RFC5737)
-                        '224.0.0.0/4',                                      # multicast address space
-                        '240.0.0.0/4',                                      # future use (RFC1122)
-                        '255.255.255.255/32'                                # limited broadcast
-                    ])
-
 '''
 OUTPUT FORMAT:
 
@@ -75,6 +76,13 @@ def print_warn(*objs):
 def print_error(*objs):
     print("[ERROR] ", *objs, file=sys.stderr)
 
+def valid_date(s):
+    try:
+        return datetime.strptime(s, "%Y-%m-%d")
+    except ValueError:
+        msg = "Not a valid date: '{0}'.".format(s)
+        raise argparse.ArgumentTypeError(msg)
+
 def getPtree (fin):
     print_log("call getPtree (%s)" % (fin))
     ts, mt, st = parseFilename(fin)
@@ -87,11 +95,27 @@ def getPtree (fin):
     ptree = ptree_cache[k]
     return ptree
 
+def getCachedStats (fin, ptree):
+    print_log("call getCachedStats (%s)" % (fin))
+    ts, mt, st = parseFilename(fin)
+    global stats_cache
+    k = (ts, mt, st)
+    if k not in stats_cache:
+        stats_cache[k] = getStats(ptree)
+    if len(stats_cache) > ptree_limit:
+        stats_cache.popitem(last=False)
+    return stats_cache[k]
+
 def loadPtree(fin):
     print_log("call loadPtree (%s)"  % (fin))
     f = (BZ2File(fin, 'rb'), gzip.open(fin, 'rb'))[fin.lower().endswith('.gz')]
     data = mrtx.parse_mrt_file(f, print_progress=verbose)
     f.close()
+    return buildPtree(data)
+
+def buildPtree(data):
+    # prefix tree of already parsed MRT data, see also bgp-pipeline
+    import radix
     ptree = radix.Radix()
     for prefix, origins in data.items():
         pnode = ptree.add(prefix)
@@ -104,6 +128,8 @@ def loadPtree(fin):
 
 def getStats (ptree):
     print_log("call getStats")
+    from netaddr import IPSet
+    reserved_ipv4 = reserved.ipv4()
     pfxlen = dict()
     pfxmoas = 0
     for p in ptree:
@@ -132,6 +158,8 @@ def getStats (ptree):
 
 def getDiffs (pt0, pt1):
     print_log("call getDiffs")
+    from netaddr import IPSet, IPNetwork
+    reserved_ipv4 = reserved.ipv4()
     num_ips_changed = 0
     num_ips_agg = 0
     num_ips_deagg = 0
@@ -156,6 +184,8 @@ def getDiffs (pt0, pt1):
 
 def parseFilename(fin):
     print_log("call parseFilename (%s)" % (fin))
+    if fin in file_info:
+        return file_info[fin]
 
     maptype = 'none'
     subtype = 'none'
@@ -203,28 +233,68 @@ def singleWorker(wd, opts):
     ts0, mt0, st0 = parseFilename(fin0)
     ts1, mt1, st1 = parseFilename(fin1)
     if (mt0 == mt1) and (st0 == st1):
-        pt0 = getPtree(fin0)
-        pt1 = getPtree(fin1)
-
-        pl0, pi0, pb0, pm0 = getStats(pt0)
-        pl1, pi1, pb1, pm1 = getStats(pt1)
-        diffs = getDiffs(pt0, pt1)
-
-        outputStats(wd,ts0,mt0,st0,pl0,pi0,pb0,pm0)
-        outputStats(wd,ts1,mt1,st1,pl1,pi1,pb1,pm1)
-        outputDiffs(wd,ts0,ts1,mt0,st0,diffs)
+        # skip finished units before loading any prefix tree
+        do_stats0 = not resume.done(mt0, st0, ts0, 'stats', fin0)
+        do_stats1 = not resume.done(mt1, st1, ts1, 'stats', fin1)
+        do_diffs = not resume.done(mt0, st0, ts0, 'diffs', fin0, fin1)
+        if not (do_stats0 or do_stats1 or do_diffs):
+            print_info("data sets exist, skipping ...")
+            return
+
+        if do_stats0 or do_diffs:
+            pt0 = getPtree(fin0)
+        if do_stats1 or do_diffs:
+            pt1 = getPtree(fin1)
+
+        if do_stats0:
+            pl0, pi0, pb0, pm0 = getCachedStats(fin0, pt0)
+            outputStats(wd,ts0,mt0,st0,pl0,pi0,pb0,pm0)
+            resume.mark(mt0, st0, ts0, 'stats', fin0)
+        if do_stats1:
+            pl1, pi1, pb1, pm1 = getCachedStats(fin1, pt1)
+            outputStats(wd,ts1,mt1,st1,pl1,pi1,pb1,pm1)
+            resume.mark(mt1, st1, ts1, 'stats', fin1)
+        if do_diffs:
+            diffs = getDiffs(pt0, pt1)
+            outputDiffs(wd,ts0,ts1,mt0,st0,diffs)
+            resume.mark(mt0, st0, ts0, 'diffs', fin0, fin1)
 
 def inputThread(file_list, stats_queue, diffs_queue):
     print_log("call inputThread")
     try:
         assert len(file_list) > 0
+        keys = [parseFilename(fin) for fin in file_list]
+        todo_files = list()
         for i in range(len(file_list)):
             fin = file_list[i]
-            ts, mt, st = parseFilename(fin)
-            pt = loadPtree(fin)
-            data = [ts,mt,st,pt]
+            ts, mt, st = keys[i]
+            # skip loading if stats and both adjacent diffs are done
+            todo = not resume.done(mt, st, ts, 'stats', fin)
+            if (not todo) and (i > 0) and (keys[i-1][1:] == (mt, st)):
+                todo = not resume.done(mt, st, keys[i-1][0], 'diffs',
+                                       file_list[i-1], fin)
+            if (not todo) and (i+1 < len(file_list)) and \
+                    (keys[i+1][1:] == (mt, st)):
+                todo = not resume.done(mt, st, ts, 'diffs',
+                                       fin, file_list[i+1])
+            if not todo:
+                print_info("data set exists, skipping ...")
+                continue
+            todo_files.append(fin)
+        # load next files while the current one is queued and analysed
+        index = dict((file_list[i], i) for i in range(len(file_list)))
+        # stats and diffs thread each get a copy of the snapshot
+        for fin, pt, nbytes in prefetch(loadPtree, todo_files,
+                                        prefetch_depth, prefetch_reserve,
+                                        governor, 2):
+            i = index[fin]
+            ts, mt, st = keys[i]
+            data = [ts,mt,st,pt,i,fin,nbytes]
             stats_queue.put(data)
             diffs_queue.put(data)
+            pt = data = None
+            print_info("inputThread, %d bytes in flight" %
+                       governor.in_flight())
     except Exception, e:
         print_error("inputThread: some error: %s" % e)
     finally:
@@ -240,19 +310,26 @@ def statsThread(queue, fout):
         data = queue.get()
         if (data == 'DONE'):
             break
+        governor.take(data[6])
         try:
             ts = data[0]
             mt = data[1]
             st = data[2]
             pt = data[3]
+            fin = data[5]
+            if resume.done(mt, st, ts, 'stats', fin):
+                continue
             calls += 1
             print_info("statsThread, call %d" % calls)
             pl, pi, pb, pm = getStats(pt)
             outputStats(fout, ts, mt, st, pl, pi, pb, pm)
+            resume.mark(mt, st, ts, 'stats', fin)
         except:
             print_error("statsThread: cannot parse data in queue!")
             errors += 1
         finally:
+            pt = None
+            governor.release(data[6])
             if errors > 10:
                 print_warn("statsThread: too many errors, stopping now!")
                 break
@@ -264,10 +341,14 @@ def diffsThread(queue, fout):
     data0 = queue.get()
     if data0 == 'DONE':
         return
+    governor.take(data0[6])
     while True:
         data1 = queue.get()
         if data1 == 'DONE':
+            governor.release(data0[6])
             break
+        # the previous snapshot is held until this one is picked up
+        governor.take(data1[6])
         try:
             ts0 = data0[0]
             ts1 = data1[0]
@@ -277,31 +358,47 @@ def diffsThread(queue, fout):
             st1 = data1[2]
             pt0 = data0[3]
             pt1 = data1[3]
-            if (mt0==mt1) and (st0==st1):
+            fin0 = data0[5]
+            fin1 = data1[5]
+            # only diff adjacent files, skipped ones leave gaps in the queue
+            if (mt0==mt1) and (st0==st1) and (data1[4] == data0[4]+1) and \
+                    not resume.done(mt0, st0, ts0, 'diffs', fin0, fin1):
                 calls += 1
                 print_info("diffThread, call %d" % calls)
                 diffs = getDiffs(pt0, pt1)
                 outputDiffs(fout, ts0, ts1, mt0, st0, diffs)
+                resume.mark(mt0, st0, ts0, 'diffs', fin0, fin1)
         except:
             print_error("diffsThread: cannot parse data in queue!")
             errors += 1
         finally:
+            pt0 = pt1 = None
+            governor.release(data0[6])
             if errors > 10:
                 print_warn("diffsThread: too many errors, stopping now!")
                 break
         data0 = data1
 
+def statsLine(ts, mt, st, pl, pi, pb, pm):
+    output = 'STATS;'+str(ts)+';'+mt+';'+st+';'
+    for p in sorted(pl.keys()):
+        output += str(pl[p])+';'
+    output += str(pi)+';'
+    output += str(pb)+';'
+    output += str(pm)
+    return output
+
+def diffsLine(ts0, ts1, mt, st, diffs):
+    output = 'DIFFS;'+str(ts0)+';'+str(ts1)+';'+mt+';'+st+';'
+    output += ';'.join(str(x) for x in diffs)
+    return output
+
 def outputStats (fout, ts, mt, st, pl, pi, pb, pm):
     global stats_print
-    k = str(ts)+'_'+mt+'_'+st
+    k = (ts, mt, st)
     if k not in stats_print:
-        stats_print.append(k)
-        output = 'STATS;'+str(ts)+';'+mt+';'+st+';'
-        for p in sorted(pl.keys()):
-            output += str(pl[p])+';'
-        output += str(pi)+';'
-        output += str(pb)+';'
-        output += str(pm)
+        stats_print.add(k)
+        output = statsLine(ts, mt, st, pl, pi, pb, pm)
         if fout:
             fn = mt+'.'+st+'.stats.csv'
             with open(fn, "a+") as f:
@@ -311,8 +408,7 @@ def outputStats (fout, ts, mt, st, pl, pi, pb, pm):
             sys.stdout.flush()
 
 def outputDiffs(fout, ts0, ts1, mt, st, diffs):
-    output = 'DIFFS;'+str(ts0)+';'+str(ts1)+';'+mt+';'+st+';'
-    output += ';'.join(str(x) for x in diffs)
+    output = diffsLine(ts0, ts1, mt, st, diffs)
     if fout:
         fn = mt+'.'+st+'.diffs.csv'
         with open(fn, "a+") as f:
@@ -332,6 +428,14 @@ def main():
     group.add_argument('-b', '--bulk',          help='Process a bunch of files in given directory (optional recursive).s')
     parser.add_argument('-r', '--recursive',    help='Search directories recursivly if in bulk mode.', action='store_true')
     parser.add_argument('-f', '--file',         help='Write results to files stats.csv and diffs.csv in working directory.', action='store_true', default=False)
+    parser.add_argument('--catalog',            help='Archive catalog file, refreshed incrementally.', default=None)
+    parser.add_argument('--begin',              help='Only files from this date (inclusive), format: yyyy-mm-dd', type=valid_date, default=None)
+    parser.add_argument('--until',              help='Only files before this date (exclusive), format: yyyy-mm-dd', type=valid_date, default=None)
+    parser.add_argument('--collector',          help='Only files of this collector (subtype), repeatable.', action='append', default=None)
+    parser.add_argument('--manifest',           help='Resume manifest, skip work already recorded there.', default=None)
+    parser.add_argument('--prefetch',           help='Number of files to load ahead in threaded mode (0: off).', type=int, default=1)
+    parser.add_argument('--prefetch-reserve',   help='Stop loading ahead if less memory [MB] is available.', type=int, default=1024)
+    parser.add_argument('--memory-budget',      help='Max. memory [MB] of snapshots in flight in threaded mode (0: unlimited).', type=int, default=0)
     args = vars(parser.parse_args())
 
     global verbose
@@ -343,6 +447,18 @@ def main():
     global logging
     logging   = args['logging']
 
+    global resume
+    resume    = Manifest(args['manifest'])
+
+    global prefetch_depth
+    prefetch_depth   = args['prefetch']
+
+    global prefetch_reserve
+    prefetch_reserve = args['prefetch_reserve'] * 1024 * 1024
+
+    global governor
+    governor  = Governor(args['memory_budget'] * 1024 * 1024)
+
     writedata = args['file']
     recursive = args['recursive']
     threads   = args['threads']
@@ -361,18 +477,14 @@ def main():
             exit(1)
 
         all_files = []
-        if recursive:
-            for dirpath, dirnames, filenames in os.walk(bulk):
-                for filename in [f for f in filenames if (re_file_rv.match(f) or re_file_rr.match(f))]:
-                    all_files.append(os.path.join(dirpath, filename))
-        else:
-            for filename in [f for f in os.listdir(bulk) if (re_file_rv.match(f) or re_file_rr.match(f))]:
-                all_files.append(os.path.join(bulk, filename))
-
-        all_files.sort()
+        for e in find_files(bulk, recursive, args['catalog'], args['begin'], args['until'], args['collector']):
+            file_info[e[0]] = e[1:4]
+            all_files.append(e[0])
         print_log("matching files: %d" % (len(all_files)))
 
         if threads:
+            # build once here, the workers inherit the tables
+            reserved.warm()
             stats_queue = Queue(queue_limit)
             diffs_queue = Queue(queue_limit)
             stats_p = Process(target=statsThread, args=((stats_queue),writedata,))
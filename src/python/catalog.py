@@ -0,0 +1,159 @@
+from __future__ import print_function
+
+import json
+import os
+import re
+
+from datetime import datetime
+
+'''
+Archive catalog for the bulk tools.
+
+The catalog caches, per directory of the archive, the directory mtime, its
+subdirectories and all matching dump files as (path, ts, maptype, subtype,
+size). A refresh only lists directories whose mtime changed since the last
+run, filenames are matched and parsed once when they are first seen.
+Month directories (YYYY.MM) outside of the selected time range are not
+visited at all.
+'''
+
+re_file_rv = re.compile('rib.(\d+).(\d\d\d\d).bz2')
+re_file_rr = re.compile('bview.(\d+).(\d\d\d\d).gz')
+
+re_path_rv = re.compile('.*/([a-z0-9\.-]+)/bgpdata/\d\d\d\d.\d\d/RIBS.*')
+re_path_rr = re.compile('.*/(rrc\d\d)/\d\d\d\d.\d\d.*')
+
+re_dir_month = re.compile('^(\d\d\d\d)\.(\d\d)$')
+
+def to_ts(dt):
+    return int((dt - datetime(1970, 1, 1)).total_seconds())
+
+def parse_filename(fin):
+    # same rules as parseFilename in the tools, None if the name is unknown
+    maptype = 'none'
+    subtype = 'none'
+    pn, fn = os.path.split(fin)
+
+    m = re_path_rr.match(pn)
+    if m:
+        maptype = 'riperis'
+        subtype = m.group(1)
+    else:
+        m = re_path_rv.match(pn)
+        if m:
+            maptype = 'routeviews'
+            subtype = m.group(1)
+
+    m = re_file_rr.match(fn)
+    if m:
+        maptype = 'riperis'
+    else:
+        m = re_file_rv.match(fn)
+        if m:
+            maptype = 'routeviews'
+        else:
+            return None
+    date = m.group(1)
+    time = m.group(2)
+    try:
+        dt = datetime.strptime(date[0:8]+time, "%Y%m%d%H%M")
+    except ValueError:
+        return None
+    return to_ts(dt), maptype, subtype
+
+def month_in_range(name, begin, until):
+    m = re_dir_month.match(name)
+    if not m:
+        return True
+    year = int(m.group(1))
+    month = int(m.group(2))
+    if not (1 <= month <= 12):
+        return True
+    m0 = datetime(year, month, 1)
+    m1 = datetime(year + month // 12, month % 12 + 1, 1)
+    if begin and (m1 <= begin):
+        return False
+    if until and (m0 >= until):
+        return False
+    return True
+
+class Catalog(object):
+
+    def __init__(self, fname=None):
+        self.fname = fname
+        self.dirs = dict()
+        self.changed = False
+        if fname and os.path.isfile(fname):
+            try:
+                with open(fname, "r") as f:
+                    self.dirs = json.load(f)
+            except ValueError:
+                self.dirs = dict()
+
+    def save(self):
+        if not (self.fname and self.changed):
+            return
+        tmp = self.fname + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.dirs, f, separators=(',', ':'))
+        os.rename(tmp, self.fname)
+        self.changed = False
+
+    def _scan(self, dirpath, mtime):
+        subdirs = list()
+        entries = list()
+        for name in os.listdir(dirpath):
+            path = os.path.join(dirpath, name)
+            if os.path.isdir(path):
+                subdirs.append(name)
+            elif re_file_rv.match(name) or re_file_rr.match(name):
+                key = parse_filename(path)
+                if key:
+                    size = os.path.getsize(path)
+                    entries.append([path, key[0], key[1], key[2], size])
+        self.dirs[dirpath] = [mtime, sorted(subdirs), entries]
+        self.changed = True
+
+    def refresh(self, path, recursive=True, begin=None, until=None):
+        # returns the directories below path that are relevant for the range
+        visited = list()
+        todo = [os.path.normpath(path)]
+        while todo:
+            dirpath = todo.pop()
+            try:
+                mtime = int(os.stat(dirpath).st_mtime)
+            except OSError:
+                continue
+            cached = self.dirs.get(dirpath)
+            if (not cached) or (cached[0] != mtime):
+                self._scan(dirpath, mtime)
+            visited.append(dirpath)
+            if recursive:
+                for name in self.dirs[dirpath][1]:
+                    if month_in_range(name, begin, until):
+                        todo.append(os.path.join(dirpath, name))
+        return visited
+
+    def select(self, dirs, begin=None, until=None, collectors=None):
+        ts0 = to_ts(begin) if begin else None
+        ts1 = to_ts(until) if until else None
+        files = list()
+        for dirpath in dirs:
+            for e in self.dirs[dirpath][2]:
+                if (ts0 is not None) and (e[1] < ts0):
+                    continue
+                if (ts1 is not None) and (e[1] >= ts1):
+                    continue
+                if collectors and (e[3] not in collectors):
+                    continue
+                files.append(tuple(e))
+        files.sort()
+        return files
+
+def find_files(path, recursive=False, fname=None,
+               begin=None, until=None, collectors=None):
+    cat = Catalog(fname)
+    dirs = cat.refresh(path, recursive, begin, until)
+    files = cat.select(dirs, begin, until, collectors)
+    cat.save()
+    return files
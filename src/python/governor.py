@@ -0,0 +1,110 @@
+from __future__ import print_function
+
+import ctypes
+import os
+import multiprocessing as mp
+
+'''
+Memory governor for the snapshot pipelines.
+
+Loaders measure the RSS growth caused by each loaded snapshot and the
+governor keeps track of the bytes of all snapshots currently in flight,
+shared by all processes of a pipeline. A new load is only admitted while
+in-flight bytes plus the expected footprint stay within the budget.
+
+In-flight bytes are either queued, i.e. admitted but not yet picked up
+by a consumer, or held by a consumer after take(). Consumers may hold a
+snapshot until the next one arrives (e.g. for diffs), so a load is always
+admitted if nothing is queued; otherwise snapshots larger than the budget
+would stall the pipeline. Loaders that consume their own snapshots never
+take() them, there one load is admitted only if nothing is in flight.
+
+Freed memory is not always returned to the OS, so a loader reusing its
+heap can measure less than a snapshot really takes. Snapshots are charged
+with the largest footprint measured so far instead.
+'''
+
+# compressed dump size to parsed snapshot size, used until measured
+expand_factor = 8
+
+def rss():
+    # resident set size of this process in bytes, 0 if unknown
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, IndexError):
+        return 0
+
+def measure(func, *args):
+    # returns func(*args) and the RSS growth it caused
+    rss0 = rss()
+    ret = func(*args)
+    return ret, max(rss() - rss0, 0)
+
+class Governor(object):
+
+    def __init__(self, budget=0):
+        self.budget = budget
+        self.cond = mp.Condition()
+        self.inflight = mp.Value(ctypes.c_longlong, 0, lock=False)
+        self.queued = mp.Value(ctypes.c_longlong, 0, lock=False)
+        self.peak = mp.Value(ctypes.c_longlong, 0, lock=False)
+
+    def in_flight(self):
+        with self.cond:
+            return self.inflight.value
+
+    def estimate(self, fin=None):
+        with self.cond:
+            if self.peak.value > 0:
+                return self.peak.value
+        if fin:
+            try:
+                return os.path.getsize(fin) * expand_factor
+            except OSError:
+                pass
+        return 0
+
+    def _fits(self, nbytes):
+        return (not self.budget) or (self.queued.value == 0) or \
+               (self.inflight.value + nbytes <= self.budget)
+
+    def try_admit(self, nbytes):
+        with self.cond:
+            if not self._fits(nbytes):
+                return False
+            self.inflight.value += nbytes
+            self.queued.value += nbytes
+            return True
+
+    def admit(self, nbytes):
+        with self.cond:
+            while not self._fits(nbytes):
+                self.cond.wait()
+            self.inflight.value += nbytes
+            self.queued.value += nbytes
+
+    def update(self, admitted, nbytes, copies=1):
+        # replace an admitted estimate by the charged footprint per copy
+        with self.cond:
+            self.peak.value = max(self.peak.value, nbytes)
+            nbytes = self.peak.value
+            self.inflight.value += nbytes * copies - admitted
+            self.queued.value += nbytes * copies - admitted
+            self.cond.notify_all()
+        return nbytes
+
+    def take(self, nbytes):
+        # a consumer picked up its copy and holds it until release()
+        with self.cond:
+            self.queued.value = max(self.queued.value - nbytes, 0)
+            self.cond.notify_all()
+
+    def release(self, nbytes, taken=True):
+        # taken=False for bytes never picked up, e.g. a failed load
+        with self.cond:
+            self.inflight.value = max(self.inflight.value - nbytes, 0)
+            if not taken:
+                self.queued.value = max(self.queued.value - nbytes, 0)
+            self.cond.notify_all()
@@ -0,0 +1,132 @@
+from __future__ import print_function
+
+import os
+import zlib
+
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+'''
+Indexed JSONL archive for the JSON output of bgp-origins.
+
+Every record (one dataset) is written as a gzip member of its own to a
+file that stays open, so the archive is still a valid gzip stream of JSON
+lines. For each record one line is appended to the sidecar index
+<archive>.idx:
+
+    maptype ; subtype ; timestamp ; offset ; length
+
+A reader seeks to the offset of a dataset and decompresses only its
+member, instead of everything in front of it. reindex() rebuilds the
+index of an archive written without one.
+'''
+
+def index_name(fname):
+    return fname + ".idx"
+
+class ArchiveWriter(object):
+
+    def __init__(self, fname, level=6):
+        self.fname = fname
+        self.level = level
+        self.f = open(fname, "ab")
+        self.f.seek(0, os.SEEK_END)
+        self.idx = open(index_name(fname), "a")
+
+    def write(self, maptype, subtype, ts, data):
+        z = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        member = z.compress(json.dumps(data) + '\n') + z.flush()
+        offset = self.f.tell()
+        self.f.write(member)
+        self.f.flush()
+        self.idx.write("%s;%s;%d;%d;%d\n" %
+                       (maptype, subtype, int(ts), offset, len(member)))
+        self.idx.flush()
+
+    def close(self):
+        self.f.close()
+        self.idx.close()
+
+def load_index(fname):
+    # list of (maptype, subtype, ts, offset, length) in order of the archive
+    entries = list()
+    if not os.path.isfile(index_name(fname)):
+        return entries
+    with open(index_name(fname), "r") as f:
+        for line in f:
+            cols = line.strip().split(';')
+            if len(cols) != 5:
+                continue
+            try:
+                entries.append((cols[0], cols[1], int(cols[2]),
+                                int(cols[3]), int(cols[4])))
+            except ValueError:
+                continue
+    return entries
+
+class ArchiveReader(object):
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.entries = load_index(fname)
+
+    def select(self, maptype=None, subtype=None, begin=None, until=None):
+        # index entries matching, begin and until as epoch [begin, until)
+        ret = list()
+        for e in self.entries:
+            if maptype and (e[0] != maptype):
+                continue
+            if subtype and (e[1] != subtype):
+                continue
+            if (begin is not None) and (e[2] < begin):
+                continue
+            if (until is not None) and (e[2] >= until):
+                continue
+            ret.append(e)
+        return ret
+
+    def records(self, maptype=None, subtype=None, begin=None, until=None):
+        # stream the matching records, reading only their own members
+        with open(self.fname, "rb") as f:
+            for e in self.select(maptype, subtype, begin, until):
+                f.seek(e[3])
+                member = f.read(e[4])
+                yield json.loads(zlib.decompress(member, 31))
+
+    def get(self, maptype, subtype, ts):
+        for data in self.records(maptype, subtype, ts, ts + 1):
+            return data
+        return None
+
+def reindex(fname, chunk=1<<20):
+    # scan all gzip members of an archive and write a fresh index
+    tmp = index_name(fname) + ".tmp"
+    with open(fname, "rb") as f, open(tmp, "w") as idx:
+        offset = 0
+        pending = ''
+        while True:
+            z = zlib.decompressobj(31)
+            text = list()
+            consumed = 0
+            while not z.unused_data:
+                if not pending:
+                    pending = f.read(chunk)
+                    if not pending:
+                        break
+                text.append(z.decompress(pending))
+                consumed += len(pending) - len(z.unused_data)
+                pending = z.unused_data
+            if not text:
+                break
+            data = json.loads(''.join(text))
+            idx.write("%s;%s;%d;%d;%d\n" %
+                      (data['maptype'], data['subtype'],
+                       int(data['timestamp']), offset, consumed))
+            offset += consumed
+            if not pending:
+                pending = f.read(chunk)
+                if not pending:
+                    break
+    os.rename(tmp, index_name(fname))
@@ -0,0 +1,66 @@
+from __future__ import print_function
+
+import os
+
+'''
+Resume manifest shared by the bulk tools.
+
+Every line of the manifest file records one finished unit of work:
+
+    maptype ; subtype ; timestamp ; kind ; fingerprint
+
+where kind names the metric (e.g. stats, diffs, ribstats, origins) and the
+fingerprint holds size and mtime of the input file(s). A unit is only
+treated as done if its input files are unchanged since it was recorded.
+'''
+
+class Manifest(object):
+
+    def __init__(self, fname=None):
+        self.fname = fname
+        self.units = dict()
+        if fname and os.path.isfile(fname):
+            with open(fname, "r") as f:
+                for line in f:
+                    if line.startswith('#'):
+                        continue
+                    cols = line.strip().split(';')
+                    if len(cols) != 5:
+                        continue
+                    try:
+                        k = (cols[0], cols[1], int(cols[2]), cols[3])
+                    except ValueError:
+                        continue
+                    self.units[k] = cols[4]
+
+    def __len__(self):
+        return len(self.units)
+
+    @staticmethod
+    def fingerprint(*files):
+        fp = list()
+        for fin in files:
+            s = os.stat(fin)
+            fp.append("%d:%d" % (s.st_size, int(s.st_mtime)))
+        return ','.join(fp)
+
+    def done(self, mt, st, ts, kind, *files):
+        if not self.fname:
+            return False
+        k = (mt, st, int(ts), kind)
+        if k not in self.units:
+            return False
+        try:
+            return self.units[k] == self.fingerprint(*files)
+        except OSError:
+            return False
+
+    def mark(self, mt, st, ts, kind, *files):
+        if not self.fname:
+            return
+        k = (mt, st, int(ts), kind)
+        fp = self.fingerprint(*files)
+        self.units[k] = fp
+        # one short line per write, safe to append from several processes
+        with open(self.fname, "a") as f:
+            f.write("%s;%s;%d;%s;%s\n" % (mt, st, int(ts), kind, fp))
@@ -0,0 +1,146 @@
+from __future__ import print_function
+
+import sys
+import threading
+
+from collections import OrderedDict
+from Queue import Queue as ThreadQueue
+
+'''
+Origins of many datasets from Postgres, shared by the origin tools.
+
+Datasets are fetched with one COPY ... TO STDOUT per monthly partition
+(t_origins_YYYY_MM), ordered by timestamp and prefix. Rows are decoded
+in batches while the server is still sending, and a dataset is handed
+out as soon as its last row arrived. iter_origins_range runs the loader
+in a thread with its own connection, so the next datasets load while the
+caller works on the current one.
+
+If a query fails, the range stops there and iter_origins_range raises
+the error after the last complete dataset, so callers never see a month
+as empty that could not be loaded.
+'''
+
+def print_error(*objs):
+    print("[ERROR] ", *objs, file=sys.stderr)
+
+class CopyReader(object):
+    # file-like target for COPY ... TO STDOUT, decodes rows in batches
+    # while the server is still sending
+    def __init__(self, func, batch=65536):
+        self.func = func
+        self.batch = batch
+        self.chunks = list()
+        self.size = 0
+        self.rest = ''
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+        if self.size >= self.batch:
+            self.flush()
+
+    def flush(self):
+        lines = (self.rest + ''.join(self.chunks)).split('\n')
+        self.rest = lines.pop()
+        self.chunks = list()
+        self.size = 0
+        for line in lines:
+            self.func(line.split('\t'))
+
+def months(datasets):
+    # group ordered (did, ts) items by their monthly partition
+    parts = OrderedDict()
+    for did, ts in datasets:
+        table = "t_origins_" + ts.strftime("%Y_%m")
+        if table not in parts:
+            parts[table] = list()
+        parts[table].append((did, ts))
+    return parts
+
+def load_range(dbconnstr, datasets, queue, shard=None):
+    # one query per month partition, ordered by (ts, prefix), each dataset
+    # is handed out as soon as its last row arrived; with shard (k, n) only
+    # prefixes with prefix_id % n == k are loaded
+    query_range = ("COPY (SELECT o.dataset_id, p.prefix, o.asn FROM %s AS o "
+                   "JOIN t_datasets AS d ON o.dataset_id = d.id "
+                   "LEFT JOIN t_prefixes AS p ON o.prefix_id = p.id "
+                   "WHERE o.dataset_id IN (%s)%s "
+                   "ORDER BY d.ts, p.prefix) TO STDOUT")
+    query_shard = ""
+    if shard:
+        query_shard = " AND o.prefix_id %% %d = %d" % (shard[1], shard[0])
+    try:
+        import psycopg2
+        con = psycopg2.connect(dbconnstr)
+    except Exception, e:
+        queue.put(Exception("load_range: connecting to database failed "
+                            "with: %s" % (e.message)))
+        queue.put('DONE')
+        return
+    cur = con.cursor()
+    try:
+        for table, items in months(datasets).items():
+            todo = list(items)
+            cur_data = [None, None]
+            def emit_until(did):
+                # datasets without any rows are handed out empty, in order
+                while todo and (todo[0][0] != did):
+                    d, t = todo.pop(0)
+                    queue.put((d, t, dict()))
+                if todo:
+                    todo.pop(0)
+            def add(cols):
+                did = int(cols[0])
+                if did != cur_data[0]:
+                    if cur_data[0] is not None:
+                        queue.put((cur_data[0], tss[cur_data[0]], cur_data[1]))
+                    emit_until(did)
+                    cur_data[0] = did
+                    cur_data[1] = dict()
+                if cols[1] == '\\N':
+                    return
+                ptree = cur_data[1]
+                prefix = cols[1]
+                origin = int(cols[2])
+                if prefix not in ptree:
+                    ptree[prefix] = list()
+                if origin not in ptree[prefix]:
+                    ptree[prefix].append(origin)
+            tss = dict(items)
+            query = query_range % (table,
+                                   ','.join(str(int(d)) for d, t in items),
+                                   query_shard)
+            try:
+                reader = CopyReader(add)
+                cur.copy_expert(query, reader)
+                reader.flush()
+            except Exception, e:
+                # the rest of the range is not handed out, see above
+                print_error("QUERY: %s ; failed with: %s" % (query, e.message))
+                con.rollback()
+                queue.put(Exception("load_range: %s failed with: %s" %
+                                    (table, e.message)))
+                break
+            if cur_data[0] is not None:
+                queue.put((cur_data[0], tss[cur_data[0]], cur_data[1]))
+            emit_until(None)
+    finally:
+        queue.put('DONE')
+        con.close()
+
+def iter_origins_range(dbconnstr, datasets, depth=2, shard=None):
+    # yields (did, ts, origins) for ordered (did, ts) items, loaded by a
+    # thread with its own connection while the caller processes; raises
+    # if loading failed, after all datasets loaded so far
+    queue = ThreadQueue(depth)
+    loader = threading.Thread(target=load_range,
+                              args=(dbconnstr, datasets, queue, shard))
+    loader.daemon = True
+    loader.start()
+    for data in iter(queue.get, 'DONE'):
+        if isinstance(data, Exception):
+            loader.join()
+            raise data
+        yield data
+    loader.join()
@@ -0,0 +1,104 @@
+from __future__ import print_function
+
+import multiprocessing as mp
+
+from collections import deque
+from itertools import chain
+
+from governor import measure
+
+'''
+Prefetch stage for the serial loops of the bulk tools.
+
+prefetch(func, items) yields (item, func(item)) in order of items, while
+up to depth following items are already decompressed and parsed by worker
+processes. A new load is only started if the system still has more than
+reserve bytes of memory available, so the read-ahead backs off instead of
+pushing the box into swap.
+
+With a governor each load is admitted against its memory budget first and
+the charged footprint is yielded as (item, func(item), nbytes). Each
+consumer of a copy has to take() it when picking it up and release() it
+once the snapshot is dropped; until taken, the next load waits for the
+budget, afterwards one load is always admitted if none is pending.
+'''
+
+def mem_available():
+    # available memory in bytes, None if unknown (non Linux)
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+def has_room(reserve):
+    if not reserve:
+        return True
+    avail = mem_available()
+    return (avail is None) or (avail > reserve)
+
+def _top_up(pool, pending, it, func, depth, reserve, governor, copies,
+            held):
+    # start loads until depth are in flight, returns the (rest of the)
+    # item iterator. Without pending loads and nothing held by the consumer
+    # one load is always started, otherwise only if memory allows.
+    while len(pending) < depth:
+        busy = bool(pending) or held
+        if busy and not has_room(reserve):
+            break
+        try:
+            item = next(it)
+        except StopIteration:
+            break
+        if governor is None:
+            pending.append((item, 0, pool.apply_async(func, (item,))))
+            continue
+        est = governor.estimate(item) * copies
+        if busy and not governor.try_admit(est):
+            # over budget, hand out pending snapshots first
+            return chain([item], it)
+        if not busy:
+            governor.admit(est)
+        pending.append((item, est, pool.apply_async(measure, (func, item))))
+    return it
+
+def prefetch(func, items, depth=1, reserve=0, governor=None, copies=1):
+    if depth < 1:
+        for item in items:
+            if governor is None:
+                yield item, func(item)
+                continue
+            est = governor.estimate(item) * copies
+            governor.admit(est)
+            ret, nbytes = measure(func, item)
+            nbytes = governor.update(est, nbytes, copies)
+            yield item, ret, nbytes
+        return
+    # fresh worker per load, so the measured RSS growth is the snapshot's
+    pool = mp.Pool(depth, maxtasksperchild=(1 if governor else None))
+    pending = deque()
+    it = iter(items)
+    try:
+        while True:
+            it = _top_up(pool, pending, it, func, depth, reserve, governor,
+                         copies, False)
+            if not pending:
+                break
+            item, est, res = pending.popleft()
+            # refill before blocking on and handing out the current result,
+            # so depth loads run while the consumer works on it
+            it = _top_up(pool, pending, it, func, depth, reserve, governor,
+                         copies, True)
+            if governor is None:
+                yield item, res.get()
+                continue
+            ret, nbytes = res.get()
+            nbytes = governor.update(est, nbytes, copies)
+            yield item, ret, nbytes
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
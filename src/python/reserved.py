@@ -0,0 +1,67 @@
+from __future__ import print_function
+
+'''
+Reserved address space, shared by the stats tools.
+
+The IPSets are built on first use only and then kept for the lifetime of
+the process, so importing a tool does not pull in netaddr. Workers forked
+after the first call inherit the tables instead of building them again;
+call warm() in the parent before starting them.
+'''
+
+reserved_ipv4 = ['0.0.0.0/8',                                       # host on this network (RFC1122)
+                 '10.0.0.0/8','172.16.0.0/12','192.168.0.0/16',     # private address space (RFC1918)
+                 '100.64.0.0/10',                                   # shared address space (RFC6598)
+                 '127.0.0.0/8',                                     # loopback (RFC1122)
+                 '169.254.0.0/16',                                  # linklocal (RFC3927)
+                 '192.0.0.0/24',                                    # special purpose (RFC6890)
+                 '192.0.0.0/29',                                    # DS-lite (RFC6333)
+                 '192.0.2.0/24','198.51.100.0/24','203.0.113.0/24', # test net 1-3 (RFC5737)
+                 '224.0.0.0/4',                                     # multicast address space
+                 '240.0.0.0/4',                                     # future use (RFC1122)
+                 '255.255.255.255/32'                               # limited broadcast
+                ]
+
+nonunicast_ipv6 = ['::1/128','::/128',          # Node-Scoped Unicast
+                   '::FFFF:0:0/96',             # IPv4-Mapped Addresses
+                   'fe80::/10',                 # Link-Scoped Unicast
+                   'fc00::/7',                  # Unique-Local
+                   '2001:0000::/23',            # IANA testing
+                   '2001:db8::/32',             # Documentation Prefix
+                   '5f00::/8','3ffe::/16',      # formerly 6bone testing
+                   'ff00::/8',                  # multicast
+                  ]
+special_ipv6 = ['2002::/16',                    # 6to4
+                '2001::/32',                    # Toredo
+                '2001:10::/28',                 # ORCHID
+               ]
+
+_tables = dict()
+
+def ipv4():
+    # IPSet of reserved IPv4 space
+    if 'ipv4' not in _tables:
+        from netaddr import IPSet
+        _tables['ipv4'] = IPSet(reserved_ipv4)
+    return _tables['ipv4']
+
+def ipv4_valid():
+    # number of valid, i.e. not reserved, IPv4 addresses
+    if 'ipv4_valid' not in _tables:
+        from netaddr import IPSet
+        _tables['ipv4_valid'] = len(IPSet(['0.0.0.0/0']) - ipv4())
+    return _tables['ipv4_valid']
+
+def ipv6():
+    # IPSet of reserved IPv6 space, non-unicast without the special ranges
+    if 'ipv6' not in _tables:
+        from netaddr import IPSet
+        _tables['ipv6'] = IPSet(nonunicast_ipv6) - IPSet(special_ipv6)
+    return _tables['ipv6']
+
+def warm(ipv6_tables=False):
+    # build the tables now, e.g. before forking workers
+    ipv4()
+    ipv4_valid()
+    if ipv6_tables:
+        ipv6()
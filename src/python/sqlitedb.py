@@ -0,0 +1,271 @@
+from __future__ import print_function
+
+import socket
+import sqlite3
+
+from datetime import datetime
+from struct import pack, unpack
+
+'''
+Embedded SQLite backend for the origins tools.
+
+Same concepts as the Postgres schema in src/db/createdb_postgre.sql:
+datasets, prefixes, one origins table per month (t_origins_YYYY_MM) and
+the result tables of the stats and ttl tools. Prefixes are stored as
+(net, masklen) pairs, net as integer for IPv4 and as 16 byte blob for
+IPv6. The database runs in WAL mode, so readers do not block the single
+writer, and origins are loaded with executemany in one transaction per
+dataset. Pairs of consecutive datasets are selected with LAG(), which
+needs SQLite 3.25 or newer.
+'''
+
+ts_format = '%Y-%m-%d %H:%M:%S'
+
+schema = '''
+CREATE TABLE IF NOT EXISTS t_datasets (
+  id          INTEGER PRIMARY KEY,
+  ts          TEXT NOT NULL,
+  maptype     TEXT NOT NULL,
+  subtype     TEXT NOT NULL,
+  UNIQUE (maptype, subtype, ts)
+);
+CREATE TABLE IF NOT EXISTS t_prefixes (
+  id          INTEGER PRIMARY KEY,
+  net         NOT NULL,
+  masklen     INTEGER NOT NULL,
+  UNIQUE (net, masklen)
+);
+CREATE TABLE IF NOT EXISTS t_origin_stats (
+  dataset_id    INTEGER PRIMARY KEY REFERENCES t_datasets (id),
+  asnums        INTEGER,
+  ips_valid     INTEGER,
+  ips_bogus     INTEGER,
+  ipspace       REAL,
+  prefixes      INTEGER,
+  prefix_moas   INTEGER,
+  prefix_len    TEXT
+);
+CREATE TABLE IF NOT EXISTS t_origin_diffs (
+  dataset_id0   INTEGER REFERENCES t_datasets (id),
+  dataset_id1   INTEGER REFERENCES t_datasets (id),
+  asn_new       INTEGER,
+  asn_del       INTEGER,
+  ips_new       INTEGER,
+  ips_del       INTEGER,
+  prefix_new    INTEGER,
+  prefix_del    INTEGER,
+  prefix_mod    INTEGER,
+  PRIMARY KEY (dataset_id0, dataset_id1)
+);
+CREATE TABLE IF NOT EXISTS t_origin_ttl (
+  id          INTEGER PRIMARY KEY,
+  ts_begin    TEXT NOT NULL,
+  ts_until    TEXT NOT NULL,
+  maptype     TEXT NOT NULL,
+  subtype     TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS t_origin_ttl_data (
+  origin_ttl_id INTEGER REFERENCES t_origin_ttl (id),
+  prefix_id     INTEGER REFERENCES t_prefixes (id),
+  asn           INTEGER,
+  ts0           TEXT NOT NULL,
+  ts1           TEXT NOT NULL,
+  ttl           INTEGER
+);
+CREATE INDEX IF NOT EXISTS i_origin_ttl_data
+  ON t_origin_ttl_data (origin_ttl_id, prefix_id);
+'''
+
+create_origins = ("CREATE TABLE IF NOT EXISTS %s ("
+                  "dataset_id INTEGER, prefix_id INTEGER, asn INTEGER, "
+                  "PRIMARY KEY (dataset_id, prefix_id, asn)) WITHOUT ROWID")
+
+# prefix -> id and id -> prefix caches of t_prefixes, per process
+prefix_ids = dict()
+prefix_names = dict()
+
+def connect(fname):
+    con = sqlite3.connect(fname, timeout=600)
+    con.text_factory = str
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.executescript(schema)
+    return con
+
+def to_datetime(ts):
+    return datetime.strptime(ts, ts_format)
+
+def origins_table(ts):
+    # monthly origins table of a dataset timestamp (string or datetime)
+    if isinstance(ts, datetime):
+        ts = ts.strftime(ts_format)
+    return "t_origins_%s_%s" % (ts[0:4], ts[5:7])
+
+def encode_prefix(prefix):
+    # (net, masklen), net as int for IPv4 and packed string for IPv6
+    net, sep, masklen = prefix.partition('/')
+    if ':' in net:
+        return socket.inet_pton(socket.AF_INET6, net), \
+               int(masklen) if sep else 128
+    return unpack('>I', socket.inet_aton(net))[0], \
+           int(masklen) if sep else 32
+
+def decode_prefix(net, masklen):
+    if isinstance(net, (int, long)):
+        return "%s/%d" % (socket.inet_ntoa(pack('>I', net)), masklen)
+    return "%s/%d" % (socket.inet_ntop(socket.AF_INET6, str(net)), masklen)
+
+def _load_prefixes(cur):
+    if prefix_names:
+        return
+    cur.execute("SELECT id, net, masklen FROM t_prefixes")
+    for pid, net, masklen in cur:
+        pfx = decode_prefix(net, masklen)
+        prefix_ids[pfx] = pid
+        prefix_names[pid] = pfx
+
+def get_prefix_ids(cur, prefixes):
+    # ids of all prefixes, unknown ones are added to t_prefixes
+    _load_prefixes(cur)
+    query_prefix = "SELECT id FROM t_prefixes WHERE net = ? AND masklen = ?"
+    insert_prefix = "INSERT OR IGNORE INTO t_prefixes (net, masklen) VALUES (?,?)"
+    for pfx in prefixes:
+        if pfx in prefix_ids:
+            continue
+        net, masklen = encode_prefix(pfx)
+        if not isinstance(net, (int, long)):
+            net = buffer(net)
+        cur.execute(insert_prefix, (net, masklen))
+        if cur.rowcount == 1:
+            pid = cur.lastrowid
+        else:
+            cur.execute(query_prefix, (net, masklen))
+            pid = cur.fetchone()[0]
+        prefix_ids[pfx] = pid
+        prefix_names[pid] = decode_prefix(net, masklen)
+    return prefix_ids
+
+def existing_datasets(con):
+    # set of (ts, maptype, subtype) of all datasets
+    cur = con.execute("SELECT ts, maptype, subtype FROM t_datasets")
+    return set(cur.fetchall())
+
+def store_origins(con, ts, maptype, subtype, origins, replace=False):
+    # write one dataset, origins as (prefix, origin ASNs) pairs
+    insert_dataset = ("INSERT OR IGNORE INTO t_datasets (ts, maptype, subtype) "
+                      "VALUES (?,?,?)")
+    query_dataset = ("SELECT id FROM t_datasets "
+                     "WHERE ts = ? AND maptype = ? AND subtype = ?")
+    table = origins_table(ts)
+    cur = con.cursor()
+    cur.execute(create_origins % table)
+    try:
+        cur.execute(insert_dataset, (ts, maptype, subtype))
+        cur.execute(query_dataset, (ts, maptype, subtype))
+        did = cur.fetchone()[0]
+        origins = list(origins)
+        pids = get_prefix_ids(cur, [prefix for prefix, asns in origins])
+        if replace:
+            cur.execute("DELETE FROM %s WHERE dataset_id = ?" % table, (did,))
+        rows = ((did, pids[prefix], int(a))
+                for prefix, asns in origins for a in asns if int(a) > 0)
+        cur.executemany("INSERT OR IGNORE INTO %s VALUES (?,?,?)" % table,
+                        rows)
+        con.commit()
+    except:
+        con.rollback()
+        raise
+    return did
+
+def get_datasets(con, begin, until, maptype, subtype, missing=False):
+    # ordered (id, ts) of datasets in [begin, until), with missing only
+    # those without stats yet
+    query_datasets = ("SELECT d.id, d.ts FROM t_datasets AS d "
+                      "WHERE d.ts >= ? AND d.ts < ? AND d.maptype = ? "
+                      "AND d.subtype = ?")
+    if missing:
+        query_datasets += (" AND NOT EXISTS (SELECT 1 FROM t_origin_stats "
+                           "AS s WHERE s.dataset_id = d.id)")
+    query_datasets += " ORDER BY d.ts"
+    cur = con.execute(query_datasets, (begin.strftime(ts_format),
+                                       until.strftime(ts_format),
+                                       maptype, subtype))
+    return [(did, to_datetime(ts)) for did, ts in cur]
+
+def get_pairs(con, begin, until, maptype, subtype):
+    # ordered (id0, ts0, id1, ts1) of consecutive datasets without diffs
+    query_pairs = ("SELECT d.id0, d.ts0, d.id1, d.ts1 FROM "
+                   "(SELECT LAG(id) OVER w AS id0, LAG(ts) OVER w AS ts0, "
+                   "id AS id1, ts AS ts1 FROM t_datasets "
+                   "WHERE ts >= ? AND ts < ? AND maptype = ? "
+                   "AND subtype = ? WINDOW w AS (ORDER BY ts)) AS d "
+                   "WHERE d.id0 IS NOT NULL AND NOT EXISTS "
+                   "(SELECT 1 FROM t_origin_diffs AS o "
+                   "WHERE o.dataset_id0 = d.id0 AND o.dataset_id1 = d.id1) "
+                   "ORDER BY d.ts1")
+    cur = con.execute(query_pairs, (begin.strftime(ts_format),
+                                    until.strftime(ts_format),
+                                    maptype, subtype))
+    return [(id0, to_datetime(ts0), id1, to_datetime(ts1))
+            for id0, ts0, id1, ts1 in cur]
+
+def get_origin_rows(con, did, ts, shard=None):
+    # yields (prefix, asn) of a dataset, rows of one prefix are adjacent;
+    # with shard (k, n) only prefixes with prefix_id % n == k
+    query_origins = ("SELECT prefix_id, asn FROM %s WHERE dataset_id = ?"
+                     % origins_table(ts))
+    if shard:
+        query_origins += " AND prefix_id %% %d = %d" % (shard[1], shard[0])
+    query_origins += " ORDER BY prefix_id"
+    cur = con.cursor()
+    _load_prefixes(cur)
+    for pid, asn in cur.execute(query_origins, (did,)).fetchall():
+        if pid not in prefix_names:
+            row = con.execute("SELECT net, masklen FROM t_prefixes "
+                              "WHERE id = ?", (pid,)).fetchone()
+            prefix_names[pid] = decode_prefix(row[0], row[1])
+        yield prefix_names[pid], asn
+
+def get_origins(con, did, ts, shard=None):
+    # prefix -> list of origin ASNs of a dataset, shard as above
+    ptree = dict()
+    for prefix, asn in get_origin_rows(con, did, ts, shard):
+        if prefix not in ptree:
+            ptree[prefix] = list()
+        ptree[prefix].append(asn)
+    return ptree
+
+def iter_origins(con, datasets, shard=None):
+    # yields (did, ts, origins) for ordered (did, ts) items
+    for did, ts in datasets:
+        yield did, ts, get_origins(con, did, ts, shard)
+
+def insert_stats(con, rows):
+    insert_stat = ("INSERT OR IGNORE INTO t_origin_stats "
+                   "VALUES (?,?,?,?,?,?,?,?)")
+    con.executemany(insert_stat, rows)
+    con.commit()
+
+def insert_diffs(con, rows):
+    insert_diff = ("INSERT OR IGNORE INTO t_origin_diffs "
+                   "VALUES (?,?,?,?,?,?,?,?,?)")
+    con.executemany(insert_diff, rows)
+    con.commit()
+
+def new_ttl(con, begin, until, maptype, subtype):
+    insert_ttl = ("INSERT INTO t_origin_ttl "
+                  "(ts_begin, ts_until, maptype, subtype) VALUES (?,?,?,?)")
+    cur = con.execute(insert_ttl, (begin.strftime('%Y-%m-%d'),
+                                   until.strftime('%Y-%m-%d'),
+                                   maptype, subtype))
+    con.commit()
+    return cur.lastrowid
+
+def insert_ttl(con, oid, rows):
+    # rows of (prefix, asn, ts0, ts1, ttl)
+    cur = con.cursor()
+    pids = get_prefix_ids(cur, set(r[0] for r in rows))
+    insert_data = "INSERT INTO t_origin_ttl_data VALUES (?,?,?,?,?,?)"
+    cur.executemany(insert_data, ((oid, pids[r[0]], r[1], r[2], r[3], r[4])
+                                  for r in rows))
+    con.commit()
@@ -0,0 +1,89 @@
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from governor import Governor, expand_factor
+from prefetch import prefetch
+
+'''
+Run from src/python with: python -m unittest discover -s tests
+'''
+
+snapshot_size = 16 * 1024 * 1024
+
+def load_snapshot(fin):
+    # stands in for loadPtree, grows the worker by about snapshot_size
+    return 'x' * snapshot_size
+
+class GovernorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        # dump files, so the first estimate is about one snapshot
+        self.files = list()
+        for i in range(4):
+            fin = os.path.join(self.path, "rib.%d.bz2" % (i))
+            with open(fin, 'wb') as f:
+                f.write('\0' * (snapshot_size // expand_factor))
+            self.files.append(fin)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def run_held(self, governor, depth):
+        # like bgp-stats -t: two copies, one dropped right away (stats) and
+        # one held until the next snapshot is picked up (diffs)
+        done = list()
+        def consume():
+            held = None
+            for fin, ret, nbytes in prefetch(load_snapshot, self.files,
+                                             depth, 0, governor, 2):
+                governor.take(nbytes)
+                governor.take(nbytes)
+                governor.release(nbytes)
+                if held is not None:
+                    governor.release(held)
+                held = nbytes
+                done.append(fin)
+            if held is not None:
+                governor.release(held)
+        t = threading.Thread(target=consume)
+        t.daemon = True
+        t.start()
+        t.join(60)
+        self.assertFalse(t.is_alive(), "stalled after %d of %d files" %
+                         (len(done), len(self.files)))
+        self.assertEqual(done, self.files)
+        self.assertEqual(governor.in_flight(), 0)
+
+    def test_held_over_budget(self):
+        # two copies plus the held one never fit into the budget
+        self.run_held(Governor(int(2.5 * snapshot_size)), 1)
+
+    def test_held_serial(self):
+        self.run_held(Governor(int(2.5 * snapshot_size)), 0)
+
+    def test_held_unlimited(self):
+        self.run_held(Governor(0), 2)
+
+    def test_queued_waits(self):
+        # without take() a second load has to wait for the budget
+        governor = Governor(snapshot_size)
+        governor.admit(snapshot_size)
+        self.assertFalse(governor.try_admit(snapshot_size))
+        governor.take(snapshot_size)
+        self.assertTrue(governor.try_admit(snapshot_size))
+        governor.release(snapshot_size)
+        governor.release(snapshot_size, False)
+        self.assertEqual(governor.in_flight(), 0)
+
+if __name__ == '__main__':
+    unittest.main()
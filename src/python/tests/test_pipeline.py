@@ -0,0 +1,100 @@
+from __future__ import print_function
+
+import imp
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+here = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, here)
+
+pipeline = imp.load_source('bgp_pipeline',
+                           os.path.join(here, 'bgp-pipeline.py'))
+
+'''
+Run from src/python with: python -m unittest discover -s tests
+'''
+
+# parsed files leave a marker file here, workers are forked and see it
+markers = None
+
+def parsed(fin):
+    return os.path.exists(os.path.join(markers, fin))
+
+def parse(fin):
+    # stands in for decompressing and parsing a RIB dump
+    open(os.path.join(markers, fin), 'w').close()
+    return {fin: [65000]}
+
+def wait_parsed(fin, timeout=30):
+    # no timing assumption, only a bound for a parse that never starts
+    deadline = time.time() + timeout
+    while not parsed(fin):
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+class MarkAnalyzer(pipeline.Analyzer):
+    # records if the next file was parsed while feeding the current one
+    name = 'mark'
+    files = list()
+    fed = list()
+    ahead = list()
+
+    def feed(self, fin, ts, mt, st, data):
+        i = self.files.index(fin)
+        if i + 1 < len(self.files):
+            self.ahead.append(wait_parsed(self.files[i+1]) if self.wait
+                              else parsed(self.files[i+1]))
+        self.fed.append((fin, data))
+
+class PipelineTest(unittest.TestCase):
+
+    files = ["rib.%d.bz2" % (i) for i in range(6)]
+
+    def setUp(self):
+        global markers
+        markers = tempfile.mkdtemp()
+        self.saved = (pipeline.parseFile, pipeline.find_files, sys.argv,
+                      pipeline.analyzers.copy())
+        entries = [(f, 1000 + i, 'TABLE_DUMP_V2', 'rrc00')
+                   for i, f in enumerate(self.files)]
+        pipeline.parseFile = parse
+        pipeline.find_files = lambda *args: entries
+        pipeline.register(MarkAnalyzer)
+        MarkAnalyzer.files = self.files
+        MarkAnalyzer.fed = list()
+        MarkAnalyzer.ahead = list()
+
+    def tearDown(self):
+        pipeline.parseFile, pipeline.find_files, sys.argv, analyzers = \
+            self.saved
+        pipeline.analyzers.clear()
+        pipeline.analyzers.update(analyzers)
+        shutil.rmtree(markers)
+
+    def run_pipeline(self, depth):
+        MarkAnalyzer.wait = depth > 0
+        sys.argv = ['bgp-pipeline', '-a', 'mark',
+                    '--prefetch', str(depth), '--prefetch-reserve', '0',
+                    markers]
+        pipeline.main()
+        self.assertEqual(MarkAnalyzer.fed,
+                         [(f, {f: [65000]}) for f in self.files])
+
+    def test_serial(self):
+        # parsed in-process, the next file only after feeding this one
+        self.run_pipeline(0)
+        self.assertEqual(MarkAnalyzer.ahead, [False] * (len(self.files)-1))
+
+    def test_overlap(self):
+        # parsing the next file overlaps with feeding the current one
+        self.run_pipeline(1)
+        self.assertEqual(MarkAnalyzer.ahead, [True] * (len(self.files)-1))
+
+if __name__ == '__main__':
+    unittest.main()
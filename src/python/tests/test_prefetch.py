@@ -0,0 +1,73 @@
+from __future__ import print_function
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from prefetch import prefetch
+
+'''
+Run from src/python with: python -m unittest discover -s tests
+'''
+
+# loads leave a marker file here, workers are forked and see it as well
+markers = None
+
+def started(item):
+    return os.path.exists(os.path.join(markers, "load.%d" % (item)))
+
+def load(item):
+    open(os.path.join(markers, "load.%d" % (item)), 'w').close()
+    return item * 2
+
+def wait_started(item, timeout=30):
+    # no timing assumption, only a bound for a load that never starts
+    deadline = time.time() + timeout
+    while not started(item):
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+class PrefetchTest(unittest.TestCase):
+
+    items = range(6)
+
+    def setUp(self):
+        global markers
+        markers = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(markers)
+
+    def test_order(self):
+        ret = list(prefetch(load, self.items, 2))
+        self.assertEqual(ret, [(i, i * 2) for i in self.items])
+
+    def test_overlap(self):
+        # the next load starts while the consumer still holds an item
+        ret = list()
+        for item, data in prefetch(load, self.items, 1):
+            if item + 1 < len(self.items):
+                self.assertTrue(wait_started(item + 1),
+                                "load %d not started while holding %d" %
+                                (item + 1, item))
+            ret.append((item, data))
+        self.assertEqual(ret, [(i, i * 2) for i in self.items])
+
+    def test_serial(self):
+        # depth 0 loads in-process, one item after the other
+        ret = list()
+        for item, data in prefetch(load, self.items, 0):
+            self.assertFalse(started(item + 1))
+            ret.append((item, data))
+        self.assertEqual(ret, [(i, i * 2) for i in self.items])
+
+if __name__ == '__main__':
+    unittest.main()